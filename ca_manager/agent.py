@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from .files import STAGING_PATH
+
+__doc__ = """
+Signing agent keeping the authority keys unlocked for the external
+tools: SSH keys are loaded in a ssh-agent, used with 'ssh-keygen -U',
+SSL keys are decrypted once into a private memory backed directory
+"""
+
+# seconds a key stays unlocked without being used
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+SWEEP_INTERVAL = 10
+
+
+class AgentKey(object):
+    def __init__(self, ca_id, kind, path, idle_timeout):
+        self.ca_id = ca_id
+        self.kind = kind
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.last_used = time.monotonic()
+
+    @property
+    def idle(self):
+        return time.monotonic() - self.last_used
+
+    def __repr__(self):
+        return ('%s key of %s, idle for %ds, locked after %ds' % (self.kind.upper(), self.ca_id, self.idle, self.idle_timeout))
+
+
+class SigningAgent(object):
+
+    def __init__(self):
+        self.keys = {}
+        self.lock = threading.RLock()
+
+        self.environment = dict(os.environ)
+        self.agent_pid = None
+        self.key_dir = None
+
+        self.sweeper = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        output = subprocess.check_output(['ssh-agent', '-s']).decode('utf-8')
+
+        for name in ('SSH_AUTH_SOCK', 'SSH_AGENT_PID'):
+            match = re.search(r'%s=([^;]+);' % name, output)
+            if not match:
+                raise ValueError('Could not parse the ssh-agent output')
+            self.environment[name] = match.group(1)
+        self.agent_pid = int(self.environment['SSH_AGENT_PID'])
+
+        # decrypted keys never go to disk, without a memory backed
+        # directory the SSL keys can not be unlocked
+        if STAGING_PATH is not None:
+            # mkdtemp creates the directory readable only by us
+            self.key_dir = tempfile.mkdtemp(prefix='ca_manager-agent-', dir=STAGING_PATH)
+
+        self.sweeper = threading.Thread(target=self.sweep, daemon=True)
+        self.sweeper.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        with self.lock:
+            for ca_path in list(self.keys):
+                self.lock_key(ca_path)
+
+        subprocess.call(['ssh-agent', '-k'], env=self.environment, stdout=subprocess.DEVNULL)
+        if self.key_dir is not None:
+            shutil.rmtree(self.key_dir, ignore_errors=True)
+
+    def sweep(self):
+        """
+        Lock the keys idle for longer than their timeout
+        """
+        while not self.stopped.wait(SWEEP_INTERVAL):
+            with self.lock:
+                for ca_path, key in list(self.keys.items()):
+                    if key.idle > key.idle_timeout:
+                        self.lock_key(ca_path)
+
+    def unlock_ssh_key(self, ca_id, ca_path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        subprocess.check_call(['ssh-add', ca_path], env=self.environment)
+
+        with self.lock:
+            self.keys[ca_path] = AgentKey(ca_id, 'ssh', ca_path, idle_timeout)
+
+    def unlock_ssl_key(self, ca_id, ca_path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        if self.key_dir is None:
+            raise ValueError('no memory backed file system to keep the decrypted key')
+
+        key_path = os.path.join(self.key_dir, os.path.basename(ca_path))
+
+        # openssl creates the key file readable only by us
+        old_umask = os.umask(0o077)
+        try:
+            subprocess.check_call(['openssl', 'pkey', '-in', ca_path, '-out', key_path])
+        finally:
+            os.umask(old_umask)
+
+        with self.lock:
+            self.keys[ca_path] = AgentKey(ca_id, 'ssl', key_path, idle_timeout)
+
+    def lock_key(self, ca_path):
+        with self.lock:
+            key = self.keys.pop(ca_path, None)
+
+        if key is None:
+            return False
+
+        if key.kind == 'ssh':
+            subprocess.call(['ssh-add', '-d', ca_path], env=self.environment, stderr=subprocess.DEVNULL)
+        elif os.path.exists(key.path):
+            os.unlink(key.path)
+        return True
+
+    def use(self, ca_path):
+        """
+        Return the unlocked key of an authority, None if it is locked
+        """
+        with self.lock:
+            key = self.keys.get(ca_path, None)
+            if key is not None:
+                key.last_used = time.monotonic()
+            return key
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.keys.values()))
+
+
+_agent = None
+
+
+def current_agent():
+    return _agent
+
+
+def start_agent():
+    """
+    Return the agent of this session, starting it if needed
+    """
+    global _agent
+
+    if _agent is None:
+        agent = SigningAgent()
+        agent.start()
+        _agent = agent
+
+        # the keys are locked however the session ends
+        atexit.register(stop_agent)
+    return _agent
+
+
+def stop_agent():
+    global _agent
+
+    if _agent is not None:
+        _agent.stop()
+        _agent = None
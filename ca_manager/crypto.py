@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import calendar
+from datetime import datetime, timedelta
+import getpass
+import os
+import re
+import threading
+import time
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import ssh
+    from cryptography.x509 import ocsp
+except ImportError:
+    serialization = None
+
+__doc__ = """
+In process signing engine, used by the authorities whose signer is
+'native'. It needs the optional cryptography package, the external
+tools are used when it is not installed.
+"""
+
+# default extensions of ssh-keygen for user certificates
+SSH_USER_EXTENSIONS = [
+    b'permit-X11-forwarding',
+    b'permit-agent-forwarding',
+    b'permit-port-forwarding',
+    b'permit-pty',
+    b'permit-user-rc',
+]
+
+_ssh_interval_units = {
+    '': 1,
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+}
+
+# valid_before of the OpenSSH certificates that never expire
+SSH_FOREVER = 2 ** 64 - 1
+
+# private keys unlocked in this session, by path
+_private_keys = {}
+_private_keys_lock = threading.Lock()
+
+# CA certificates, by path and modification time
+_certificates = {}
+
+
+class NativeSigningError(Exception):
+    pass
+
+
+def native_available():
+    return serialization is not None
+
+
+def load_private_key(path, loader):
+    """
+    Return the private key stored in path, asking for its
+    passphrase only the first time in the session
+    """
+    # signing workers wait for a single passphrase prompt
+    with _private_keys_lock:
+        if path not in _private_keys:
+            with open(path, 'rb') as stream:
+                key_data = stream.read()
+
+            try:
+                key = loader(key_data, None)
+            except TypeError:
+                # the key is encrypted
+                passphrase = getpass.getpass('Passphrase for %s: ' % path)
+                key = loader(key_data, passphrase.encode('utf-8'))
+
+            _private_keys[path] = key
+
+        return _private_keys[path]
+
+
+def forget_private_keys():
+    _private_keys.clear()
+
+
+def unlock_private_key(path, kind):
+    """
+    Load the 'ssh' or 'ssl' private key stored in path now, so
+    signing with it later never stops to ask for the passphrase
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    loaders = {
+        'ssh': serialization.load_ssh_private_key,
+        'ssl': serialization.load_pem_private_key,
+    }
+    load_private_key(path, loaders[kind])
+
+
+def private_key_loaded(path):
+    with _private_keys_lock:
+        return path in _private_keys
+
+
+def load_certificate(path):
+    """
+    Return the PEM certificate stored in path, parsed
+    again only when the file changes
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _certificates.get(path, None)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as stream:
+            cached = (mtime, x509.load_pem_x509_certificate(stream.read()))
+        _certificates[path] = cached
+
+    return cached[1]
+
+
+def parse_ssh_interval(interval):
+    """
+    Convert a ssh-keygen relative time, such as '+52w' or
+    '+1w2d', into seconds
+    """
+    match = re.fullmatch(r'\+?((\d+[smhdwSMHDW]?)+)', interval.strip())
+    if not match:
+        raise ValueError('Invalid validity interval: %s' % interval)
+
+    seconds = 0
+    for value, unit in re.findall(r'(\d+)([smhdwSMHDW]?)', match.group(1)):
+        seconds += int(value) * _ssh_interval_units[unit.lower()]
+    return seconds
+
+
+def ssh_validity(interval, now=None):
+    """
+    Return the (valid_after, valid_before) timestamps that ssh-keygen
+    uses for '-V interval': from a minute ago, to allow for clock
+    skew, until interval from now
+    """
+    if now is None:
+        now = int(time.time())
+    now -= now % 60
+
+    return now - 60, now + parse_ssh_interval(interval)
+
+
+def sign_ssh_certificate(ca_key_path, key_data, key_id, principals, serial, interval, host=False):
+    """
+    Build and sign an OpenSSH certificate in memory, the result
+    has the same layout as the -cert.pub files of ssh-keygen
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    fields = key_data.strip().split(None, 2)
+    comment = fields[2] if len(fields) > 2 else None
+
+    try:
+        ca_key = load_private_key(ca_key_path, serialization.load_ssh_private_key)
+        public_key = serialization.load_ssh_public_key(' '.join(fields[:2]).encode('utf-8'))
+    except UnsupportedAlgorithm as e:
+        raise NativeSigningError(e)
+
+    valid_after, valid_before = ssh_validity(interval)
+
+    builder = (
+            ssh.SSHCertificateBuilder()
+            .public_key(public_key)
+            .serial(serial)
+            .key_id(key_id.encode('utf-8'))
+            .valid_principals([principal.encode('utf-8') for principal in principals])
+            .valid_after(valid_after)
+            .valid_before(valid_before)
+            )
+
+    if host:
+        builder = builder.type(ssh.SSHCertificateType.HOST)
+    else:
+        builder = builder.type(ssh.SSHCertificateType.USER)
+        for extension in SSH_USER_EXTENSIONS:
+            builder = builder.add_extension(extension, b'')
+
+    try:
+        certificate = builder.sign(ca_key).public_bytes()
+    except (ValueError, TypeError, UnsupportedAlgorithm) as e:
+        raise NativeSigningError(e)
+
+    if comment:
+        certificate += b' ' + comment.encode('utf-8')
+
+    return certificate + b'\n'
+
+
+def sign_x509_certificate(ca_key_path, ca_cert_path, csr_data, serial, days, is_ca=False, digest='sha256', ocsp_url=None):
+    """
+    Issue a PEM certificate for a PEM certificate signing request,
+    like 'openssl x509 -req' does but without leaving the process
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    try:
+        ca_key = load_private_key(ca_key_path, serialization.load_pem_private_key)
+        algorithm = getattr(hashes, digest.upper())()
+    except (AttributeError, UnsupportedAlgorithm) as e:
+        raise NativeSigningError(e)
+
+    if serial <= 0:
+        raise NativeSigningError('X.509 serial numbers must be positive')
+
+    ca_cert = load_certificate(ca_cert_path)
+    csr = x509.load_pem_x509_csr(csr_data.encode('utf-8'))
+
+    if not csr.is_signature_valid:
+        raise ValueError('The certificate request signature is not valid')
+
+    now = datetime.utcnow()
+
+    builder = (
+            x509.CertificateBuilder()
+            .subject_name(csr.subject)
+            .issuer_name(ca_cert.subject)
+            .public_key(csr.public_key())
+            .serial_number(serial)
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=int(days)))
+            .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(csr.public_key()), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False)
+            )
+
+    if ocsp_url:
+        builder = builder.add_extension(x509.AuthorityInformationAccess([
+            x509.AccessDescription(x509.AuthorityInformationAccessOID.OCSP, x509.UniformResourceIdentifier(ocsp_url)),
+            ]), critical=False)
+
+    try:
+        certificate = builder.sign(ca_key, algorithm)
+    except (ValueError, TypeError, UnsupportedAlgorithm) as e:
+        raise NativeSigningError(e)
+
+    return certificate.public_bytes(serialization.Encoding.PEM)
+
+
+def _local_time(utc_time):
+    # the database stores naive local times, as datetime.now()
+    return datetime.fromtimestamp(calendar.timegm(utc_time.utctimetuple()))
+
+
+def ssh_certificate_dates(data):
+    """
+    Return the (not_before, not_after) local times of an OpenSSH
+    certificate, None for a bound the certificate doesn't have
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    try:
+        certificate = ssh.load_ssh_public_identity(data.strip())
+    except UnsupportedAlgorithm as e:
+        raise NativeSigningError(e)
+
+    not_before = datetime.fromtimestamp(certificate.valid_after) if certificate.valid_after else None
+    not_after = datetime.fromtimestamp(certificate.valid_before) if certificate.valid_before != SSH_FOREVER else None
+
+    return not_before, not_after
+
+
+def x509_certificate_dates(data):
+    """
+    Return the (not_before, not_after) local times of the
+    first certificate of a PEM chain
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    certificate = x509.load_pem_x509_certificate(data)
+
+    # the aware properties replace the naive ones since cryptography 42
+    if hasattr(certificate, 'not_valid_after_utc'):
+        return _local_time(certificate.not_valid_before_utc), _local_time(certificate.not_valid_after_utc)
+    return _local_time(certificate.not_valid_before), _local_time(certificate.not_valid_after)
+
+
+def x509_certificate_serial(data):
+    """
+    Return the serial number of the first certificate of a PEM chain
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    return x509.load_pem_x509_certificate(data).serial_number
+
+
+def _utc_time(local_time):
+    return datetime.utcfromtimestamp(time.mktime(local_time.timetuple()))
+
+
+def sign_crl(ca_key_path, ca_cert_path, revoked, crl_number, last_update, next_update,
+             base_crl_number=None, digest='sha256'):
+    """
+    Sign a CRL listing the revoked (serial, revocation_date, reason)
+    entries, a delta CRL of the full CRL base_crl_number when given,
+    return it DER and PEM encoded
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    ca_key = load_private_key(ca_key_path, serialization.load_pem_private_key)
+    ca_cert = load_certificate(ca_cert_path)
+
+    builder = (
+            x509.CertificateRevocationListBuilder()
+            .issuer_name(ca_cert.subject)
+            .last_update(_utc_time(last_update))
+            .next_update(_utc_time(next_update))
+            .add_extension(x509.CRLNumber(crl_number), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False)
+            )
+
+    if base_crl_number is not None:
+        builder = builder.add_extension(x509.DeltaCRLIndicator(base_crl_number), critical=True)
+
+    for serial, revocation_date, reason in revoked:
+        entry = (
+                x509.RevokedCertificateBuilder()
+                .serial_number(serial)
+                .revocation_date(_utc_time(revocation_date or last_update))
+                )
+
+        # RFC 5280 asks to leave out the unspecified reason
+        if reason and reason != 'unspecified':
+            entry = entry.add_extension(x509.CRLReason(x509.ReasonFlags[reason]), critical=False)
+
+        builder = builder.add_revoked_certificate(entry.build())
+
+    crl = builder.sign(ca_key, getattr(hashes, digest.upper())())
+
+    return crl.public_bytes(serialization.Encoding.DER), crl.public_bytes(serialization.Encoding.PEM)
+
+
+def ocsp_issuer_hashes(ca_cert_path):
+    """
+    Return the SHA1 hashes of the name and of the public key of a
+    CA, used by OCSP requests to identify the issuer
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    ca_cert = load_certificate(ca_cert_path)
+
+    name_hash = hashes.Hash(hashes.SHA1())
+    name_hash.update(ca_cert.subject.public_bytes())
+    key_hash = x509.SubjectKeyIdentifier.from_public_key(ca_cert.public_key()).digest
+
+    return name_hash.finalize(), key_hash
+
+
+def load_ocsp_request(data):
+    """
+    Return the (issuer_name_hash, issuer_key_hash, serial) of
+    a DER encoded OCSP request
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    request = ocsp.load_der_ocsp_request(data)
+    if not isinstance(request.hash_algorithm, hashes.SHA1):
+        raise ValueError('Only SHA1 certificate ids are supported')
+
+    return request.issuer_name_hash, request.issuer_key_hash, request.serial_number
+
+
+def sign_ocsp_response(ca_key_path, ca_cert_path, serial, revoked, revocation_date, reason,
+                       this_update, next_update, cert_path=None, digest='sha256'):
+    """
+    Sign a DER encoded OCSP response about a certificate issued by a
+    CA, cert_path is only read by cryptography versions older than 43
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    ca_key = load_private_key(ca_key_path, serialization.load_pem_private_key)
+    ca_cert = load_certificate(ca_cert_path)
+
+    status = ocsp.OCSPCertStatus.REVOKED if revoked else ocsp.OCSPCertStatus.GOOD
+    status_details = dict(
+            cert_status=status,
+            this_update=_utc_time(this_update),
+            next_update=_utc_time(next_update),
+            revocation_time=_utc_time(revocation_date or this_update) if revoked else None,
+            revocation_reason=x509.ReasonFlags[reason] if revoked and reason else None,
+            )
+
+    builder = ocsp.OCSPResponseBuilder()
+    if hasattr(builder, 'add_response_by_hash'):
+        name_hash, key_hash = ocsp_issuer_hashes(ca_cert_path)
+        builder = builder.add_response_by_hash(name_hash, key_hash, serial, hashes.SHA1(), **status_details)
+    else:
+        with open(cert_path, 'rb') as stream:
+            cert = x509.load_pem_x509_certificate(stream.read())
+        builder = builder.add_response(cert, ca_cert, hashes.SHA1(), **status_details)
+
+    response = (
+            builder
+            .responder_id(ocsp.OCSPResponderEncoding.HASH, ca_cert)
+            .sign(ca_key, getattr(hashes, digest.upper())())
+            )
+
+    return response.public_bytes(serialization.Encoding.DER)
+
+
+def ocsp_error(status):
+    """
+    DER encoded unsigned OCSP response, status is one of
+    'malformed_request', 'internal_error' or 'unauthorized'
+    """
+    if not native_available():
+        raise NativeSigningError('the cryptography package is not installed')
+
+    response = ocsp.OCSPResponseBuilder.build_unsuccessful(ocsp.OCSPResponseStatus[status.upper()])
+
+    return response.public_bytes(serialization.Encoding.DER)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+
+from playhouse.gfk import get_model
+
+from .lookup import filter_certificates
+from .models.certificate import Certificate
+
+__doc__ = """
+Machine readable dump of the issued certificates, streamed row by row
+so the memory used doesn't depend on the number of certificates
+"""
+
+EXPORT_FORMATS = ['jsonl', 'csv', ]
+
+EXPORT_COLUMNS = [
+    'cert_id',
+    'authority_type',
+    'ca_id',
+    'receiver',
+    'serial_number',
+    'issued_serial',
+    'date_issued',
+    'not_before',
+    'not_after',
+    'validity_interval',
+    'revoked',
+    'path',
+]
+
+_selected_fields = [
+    Certificate.cert_id,
+    Certificate.authority_type,
+    Certificate.authority_id,
+    Certificate.receiver,
+    Certificate.serial_number,
+    Certificate.issued_serial,
+    Certificate.date_issued,
+    Certificate.not_before,
+    Certificate.not_after,
+    Certificate.validity_interval,
+    Certificate.revoked,
+    Certificate.path,
+]
+
+
+def _export_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _read_body(path):
+    try:
+        with open(path, 'r') as stream:
+            return stream.read()
+    except OSError:
+        return None
+
+
+def _ca_ids(authority_type):
+    """
+    Map the ids of an authority table to their ca_id
+    """
+    model = get_model(authority_type)
+    if model is None:
+        return {}
+
+    return dict(model.select(model.id, model.ca_id).tuples())
+
+
+def certificate_rows(include_body=False, **filters):
+    """
+    Yield a dict for each certificate, filters are the ones of
+    lookup.filter_certificates
+
+    Rows are read as tuples with an iterator, and the ca_id of their
+    authorities from a map read once per authority table
+    """
+    query = filter_certificates(Certificate.select(*_selected_fields), **filters)
+
+    # authority_type: {authority_id: ca_id}
+    ca_ids = {}
+
+    for row in query.order_by(Certificate.id).tuples().iterator():
+        values = list(row)
+
+        authority_type, authority_id = values[1], values[2]
+        if authority_type and authority_type not in ca_ids:
+            ca_ids[authority_type] = _ca_ids(authority_type)
+        # the authority may have been deleted
+        values[2] = ca_ids.get(authority_type, {}).get(authority_id, None)
+
+        exported = dict(zip(EXPORT_COLUMNS, [_export_value(value) for value in values]))
+        if include_body:
+            # read only when the row is written
+            exported['certificate'] = _read_body(exported['path'])
+        yield exported
+
+
+def export_certificates(stream, output_format='jsonl', include_body=False, **filters):
+    """
+    Write the certificates to a text stream as JSON lines or CSV,
+    return the number of rows written
+    """
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format '%s'" % output_format)
+
+    columns = EXPORT_COLUMNS + (['certificate', ] if include_body else [])
+
+    if output_format == 'csv':
+        writer = csv.DictWriter(stream, columns)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(row):
+            stream.write(json.dumps(row))
+            stream.write('\n')
+
+    count = 0
+    for row in certificate_rows(include_body, **filters):
+        write(row)
+        count += 1
+
+    return count
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+
+from .paths import SHARD_LEVELS
+
+__doc__ = """
+Helpers to place files in the CA manager directories
+"""
+
+# memory backed directory used for the files external tools need
+STAGING_PATH = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# file contents, by path and modification time
+_file_cache = {}
+
+
+def shard_path(directory, name, levels=None):
+    """
+    Path of the file name in directory, nested in levels of
+    directories named after the first bytes of its hash
+    """
+    if levels is None:
+        levels = SHARD_LEVELS
+
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    shards = [digest[2 * i:2 * i + 2] for i in range(levels)]
+
+    return os.path.join(directory, *(shards + [name]))
+
+
+def leaf_directories(directory, levels=None):
+    """
+    Yield the directories holding the files of a sharded directory
+    """
+    if levels is None:
+        levels = SHARD_LEVELS
+
+    if levels == 0:
+        yield directory
+        return
+
+    for entry in os.scandir(directory):
+        if len(entry.name) == 2 and entry.is_dir(follow_symlinks=False):
+            for leaf in leaf_directories(entry.path, levels - 1):
+                yield leaf
+
+
+def _temp_path(path):
+    directory, name = os.path.split(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, '.%s.tmp' % name)
+
+
+def write_atomic(path, data):
+    """
+    Write data to a temporary file next to path and
+    rename it in place
+    """
+    temp_path = _temp_path(path)
+
+    with open(temp_path, 'wb') as stream:
+        stream.write(data)
+    os.rename(temp_path, path)
+
+
+def link_atomic(source, path):
+    """
+    Publish source as path with a hard link, copying it
+    when the two are on different file systems
+    """
+    temp_path = _temp_path(path)
+
+    if os.path.lexists(temp_path):
+        os.unlink(temp_path)
+
+    try:
+        os.link(source, temp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(source, temp_path)
+
+    os.rename(temp_path, path)
+
+
+def symlink_atomic(target, path):
+    """
+    Point the symbolic link path to target, replacing
+    the previous link in a single step
+    """
+    temp_path = _temp_path(path)
+
+    if os.path.lexists(temp_path):
+        os.unlink(temp_path)
+
+    os.symlink(target, temp_path)
+    os.rename(temp_path, path)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on path, created if missing,
+    shared with the other processes using it
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, 'a') as stream:
+        fcntl.flock(stream, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+
+
+def read_cached(path):
+    """
+    Return the content of path, read again only
+    when the file changes
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _file_cache.get(path, None)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as stream:
+            cached = (mtime, stream.read())
+        _file_cache[path] = cached
+
+    return cached[1]
+
+
+def staging_directory():
+    """
+    Private temporary directory, in memory when possible
+    """
+    return tempfile.TemporaryDirectory(prefix='ca_manager-', dir=STAGING_PATH)
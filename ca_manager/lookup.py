@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from itertools import chain
+from bisect import bisect_right
+from datetime import datetime
+from itertools import islice
 import json
 import os
 import os.path
+import threading
+
+from playhouse.gfk import get_model
 
 from .models.ssh import SSHAuthority, UserSSHRequest, HostSSHRequest
 from .models.ssl import SSLAuthority, UserSSLRequest, HostSSLRequest, CASSLRequest
 
+from .models.authority import Authority, authority_registry
 from .models.certificate import Certificate
-from .models.request import SignRequest
+from .models.customModel import custom_db
+from .models.request import REQUEST_INDEX_LOCK_PATH, SignRequest, parse_queue_cursor
+
+from .files import file_lock, leaf_directories
 
 from .paths import *
 
@@ -18,63 +27,291 @@ from .paths import *
 class CALookup:
     """
     Proxy to interact with authorities
-    """
 
-    allowed_auth = [
-            SSHAuthority,
-            SSLAuthority,
-            ]
+    Authorities of every registered type are kept in an index by
+    ca_id, loaded again when an authority is saved in this process
+    or when another connection changes the database
+    """
 
     def __init__(self):
 
         self.path = MANAGER_PATH
 
+        self._authorities = None
+        self._index = None
+        self._generation = None
+        self._seen = threading.local()
+
+    @property
+    def allowed_auth(self):
+        return list(authority_registry.values())
+
+    def _is_stale(self):
+        # data_version only changes for commits of other connections
+        data_version = custom_db.execute_sql('PRAGMA data_version').fetchone()[0]
+        changed = getattr(self._seen, 'data_version', None) != data_version
+        self._seen.data_version = data_version
+
+        return changed or self._index is None or self._generation != Authority.generation
+
+    def _load(self):
+        self._generation = Authority.generation
+
+        authorities = []
+        index = {}
+        for authority_type in self.allowed_auth:
+            for ca in authority_type.select():
+                authorities.append(ca)
+                index.setdefault(ca.ca_id, ca)
+
+        self._authorities, self._index = authorities, index
+
     def __iter__(self):
 
-        all_the_authorities = [auth.select().iterator() for auth in self.allowed_auth]
+        if self._is_stale():
+            self._load()
 
-        return chain.from_iterable(all_the_authorities)
+        return iter(self._authorities)
 
     def __getitem__(self, ca_id):
 
-        for authority_type in self.allowed_auth:
-            try:
-                ca = authority_type.get(authority_type.ca_id == ca_id)
-                return ca
-            except authority_type.DoesNotExist:
-                continue
+        if self._is_stale():
+            self._load()
+
+        return self._index.get(ca_id, None)
+
+    def query(self, authority_type=None, after=None, limit=None):
+        """
+        Authorities sorted by ca_id, optionally only the ones of
+        authority_type, starting after the ca_id given as cursor
+        """
+        authorities = sorted(self, key=lambda ca: ca.ca_id)
+
+        if authority_type is not None:
+            authorities = [ca for ca in authorities if isinstance(ca, authority_type)]
+
+        if after is not None:
+            authorities = [ca for ca in authorities if ca.ca_id > after]
+
+        return authorities[:limit]
+
+
+# request classes, by keyType
+request_types = dict(
+        (request_class.key_type, request_class)
+        for request_class in (UserSSHRequest, HostSSHRequest, UserSSLRequest, HostSSLRequest, CASSLRequest)
+        )
 
 
 class RequestLookup:
     """
     Proxy to interact with the requests
+
+    Parsed requests are cached with the modification time and size
+    of their file, so only new or changed files are read again, and
+    only the directories modified since the last scan are listed.
+    The emptied shard directories are removed, a scan only goes
+    through the shards holding requests
+
+    Requests come out as a queue: higher priority first, then
+    the oldest submission
     """
     def __init__(self):
         self.request_dir = REQUESTS_PATH
         self.output_dir = OUTPUT_PATH
 
+        # request_id: (mtime, size, request)
+        self._cache = {}
+        # queue keys of the cached requests, sorted
+        self._queue = []
+        # directory: (mtime, {request_id: (mtime, size, request)})
+        self._directories = {}
+
+    def refresh(self):
+        """
+        Bring the cache up to date with REQUESTS_PATH
+        """
+        directories = {}
+        changed = False
+
+        for directory in leaf_directories(self.request_dir):
+            dir_mtime = os.stat(directory).st_mtime_ns
+            cached = self._directories.get(directory, None)
+
+            # files are only added, renamed in place or removed,
+            # all of them change the directory modification time
+            if cached is not None and cached[0] == dir_mtime:
+                directories[directory] = cached
+                continue
+
+            entries = self._scan(directory, cached[1] if cached else {})
+            changed = True
+
+            if not entries and self._prune(directory):
+                continue
+            directories[directory] = (dir_mtime, entries)
+
+        if changed or directories.keys() != self._directories.keys():
+            cache = {}
+            for dir_mtime, entries in directories.values():
+                cache.update(entries)
+            self._cache = cache
+            self._queue = sorted(request.queue_key for mtime, size, request in cache.values() if request is not None)
+
+        self._directories = directories
+
+    def _prune(self, directory):
+        """
+        Remove a shard directory and its parents while they are empty,
+        return whether directory was removed
+        """
+        root = os.path.normpath(self.request_dir)
+        directory = os.path.normpath(directory)
+        removed = False
+
+        # ca-server creates the shard directories holding the same lock
+        with file_lock(REQUEST_INDEX_LOCK_PATH):
+            while directory.startswith(root + os.sep):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                removed = True
+                directory = os.path.dirname(directory)
+
+        return removed
+
+    def _scan(self, directory, previous):
+        entries = {}
+        for entry in os.scandir(directory):
+            # skip the files being written
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            cached = previous.get(entry.name, None)
+
+            if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                entries[entry.name] = cached
+                continue
+
+            try:
+                request = self.load(entry.name)
+            except (OSError, ValueError, AssertionError):
+                request = None
+            entries[entry.name] = (stat.st_mtime_ns, stat.st_size, request)
+
+        return entries
+
     def __iter__(self):
         """
-        Iterate over all certificate request in REQUEST_PATH
+        Iterate over all certificate request in REQUEST_PATH,
+        in queue order
         """
 
-        for request_id in os.listdir(self.request_dir):
+        self.refresh()
+
+        for priority, timestamp, request_id in list(self._queue):
             """
             request_id is formatted as uuid
             """
-            yield self[request_id]
+            # deleted since the last refresh
+            cached = self._cache.get(request_id, None)
+            if cached is not None and cached[2] is not None:
+                yield cached[2]
+
+    def status(self):
+        """
+        Return the number of pending requests, the oldest
+        one and the number of requests by keyType
+        """
+        depth, oldest, counts = 0, None, {}
+
+        for request in self:
+            depth += 1
+            counts[request.key_type] = counts.get(request.key_type, 0) + 1
+
+            if request.submitted_at is not None and (oldest is None or request.submitted_at < oldest.submitted_at):
+                oldest = request
+
+        return depth, oldest, counts
+
+    def query(self, request_type=None, receiver_prefix=None, after=None, limit=None):
+        """
+        Requests in queue order, filtered by type (a keyType such
+        as 'ssh_host') and receiver prefix, starting after the
+        queue_cursor of a request
+        """
+        self.refresh()
+
+        request_class = None
+        if request_type is not None:
+            request_class = request_types[request_type]
+
+        start = bisect_right(self._queue, parse_queue_cursor(after)) if after is not None else 0
+
+        requests = []
+        for position in range(start, len(self._queue)):
+            priority, timestamp, request_id = self._queue[position]
+            # deleted since the last refresh
+            cached = self._cache.get(request_id, None)
+            if cached is None or cached[2] is None:
+                continue
+
+            request = cached[2]
+            if request_class is not None and type(request) != request_class:
+                continue
+            if receiver_prefix is not None and not request.receiver.startswith(receiver_prefix):
+                continue
+
+            requests.append(request)
+            if limit is not None and len(requests) == limit:
+                break
+
+        return requests
 
     def __delitem__(self, request_id):
         """
         Delete a specific certificate request
         """
-        os.unlink(SignRequest(request_id).path)
+        cached = self._cache.get(request_id, None)
+        request = cached[2] if cached is not None else None
+
+        # ca-server rewrites the duplicates holding the same lock, a
+        # resubmission can't bring back the file of a signed request
+        with file_lock(REQUEST_INDEX_LOCK_PATH):
+            path = SignRequest(request_id).path
+            os.unlink(path)
+            self._cache.pop(request_id, None)
+
+            # drop the link used by ca-server to find duplicates
+            if request is not None and request.key_type is not None:
+                try:
+                    if os.readlink(request.index_path) == request_id:
+                        os.unlink(request.index_path)
+                except OSError:
+                    pass
+
+        self._prune(os.path.dirname(path))
 
     def __getitem__(self, request_id):
         """
         Get a specific certificate request
         """
 
+        self.refresh()
+
+        cached = self._cache.get(request_id, None)
+        if cached is not None and cached[2] is not None:
+            return cached[2]
+
+        return self.load(request_id)
+
+    def load(self, request_id):
+        """
+        Read a certificate request from its file
+        """
+
         with open(SignRequest(request_id).path, 'r') as stream:
             request_data = json.load(
                     stream,
@@ -89,7 +326,7 @@ class RequestLookup:
             values = request_data.values()
 
             if 'ssh_user' in values:
-                return UserSSHRequest(
+                request = UserSSHRequest(
                         request_id,
                         requester,
                         root_requested,
@@ -97,28 +334,28 @@ class RequestLookup:
                         )
 
             elif 'ssh_host' in values:
-                return HostSSHRequest(
+                request = HostSSHRequest(
                         request_id,
                         requester,
                         key_data,
                         )
 
             elif 'ssl_host' in values:
-                return HostSSLRequest(
+                request = HostSSLRequest(
                         request_id,
                         requester,
                         key_data,
                         )
 
             elif 'ssl_user' in values:
-                return UserSSLRequest(
+                request = UserSSLRequest(
                         request_id,
                         requester,
                         key_data,
                         )
 
             elif 'ssl_ca' in values:
-                return CASSLRequest(
+                request = CASSLRequest(
                         request_id,
                         requester,
                         key_data,
@@ -126,6 +363,18 @@ class RequestLookup:
             else:
                 return SignRequest(request_id)
 
+            # equal requests sent again to ca-server
+            request.submissions = request_data.get('submissions', 1)
+            request.priority = request_data.get('priority', 0)
+
+            # requests queued by older versions are as old as their file
+            submitted_at = request_data.get('submittedAt', None)
+            if submitted_at is None:
+                submitted_at = os.fstat(stream.fileno()).st_mtime
+            request.submitted_at = datetime.fromtimestamp(submitted_at)
+
+            return request
+
     @property
     def ssh(self):
         pass
@@ -155,4 +404,113 @@ class CertificateLookup:
         """
         Iterate over all certificate request in OUTPUT_PATH
         """
-        return Certificate.select().iterator()
+        return attach_authorities(Certificate.select().iterator())
+
+    def query(self, authority=None, receiver_prefix=None, revoked=None,
+              issued_after=None, issued_before=None, after=None, limit=None):
+        """
+        Certificates sorted by id, filtered by authority, receiver
+        prefix, revocation and issue date, starting after the id given
+        as cursor: every page costs the same however deep it is
+        """
+        query = filter_certificates(
+                Certificate.select(),
+                authority=authority,
+                receiver_prefix=receiver_prefix,
+                revoked=revoked,
+                issued_after=issued_after,
+                issued_before=issued_before,
+                )
+
+        if after is not None:
+            query = query.where(Certificate.id > after)
+
+        query = query.order_by(Certificate.id)
+        if limit is not None:
+            query = query.limit(limit)
+
+        return list(attach_authorities(query.iterator()))
+
+    def expiring(self, within, authority=None, include_revoked=False):
+        """
+        Certificates expiring in the next 'within' timedelta, soonest
+        first, optionally only the ones issued by authority
+        """
+        now = datetime.now()
+        query = Certificate.select().where(
+                (Certificate.not_after >= now) &
+                (Certificate.not_after <= now + within)
+                )
+
+        if authority is not None:
+            query = query.where(
+                    (Certificate.authority_type == authority._meta.db_table) &
+                    (Certificate.authority_id == authority.id)
+                    )
+
+        if not include_revoked:
+            query = query.where(Certificate.revoked == False)
+
+        return attach_authorities(query.order_by(Certificate.not_after).iterator())
+
+
+def filter_certificates(query, authority=None, receiver_prefix=None, revoked=None,
+                        issued_after=None, issued_before=None):
+    """
+    Restrict a select on Certificate, of models or of tuples
+    """
+    if authority is not None:
+        query = query.where(
+                (Certificate.authority_type == authority._meta.db_table) &
+                (Certificate.authority_id == authority.id)
+                )
+
+    if receiver_prefix:
+        # a range instead of LIKE, so the receiver index is used
+        query = query.where(
+                (Certificate.receiver >= receiver_prefix) &
+                (Certificate.receiver < receiver_prefix + '\uffff')
+                )
+
+    if revoked is not None:
+        query = query.where(Certificate.revoked == revoked)
+
+    if issued_after is not None:
+        query = query.where(Certificate.date_issued >= issued_after)
+
+    if issued_before is not None:
+        query = query.where(Certificate.date_issued < issued_before)
+
+    return query
+
+
+def attach_authorities(certificates, chunk_size=500):
+    """
+    Yield the certificates with their authority already resolved,
+    fetching the authorities with one query per type and chunk
+    instead of one query per certificate
+    """
+    authorities = {}
+    certificates = iter(certificates)
+
+    while True:
+        chunk = list(islice(certificates, chunk_size))
+        if not chunk:
+            return
+
+        missing = {}
+        for cert in chunk:
+            key = (cert.authority_type, cert.authority_id)
+            if cert.authority_type and key not in authorities:
+                missing.setdefault(cert.authority_type, set()).add(cert.authority_id)
+
+        for authority_type, authority_ids in missing.items():
+            model = get_model(authority_type)
+            for authority in model.select().where(model.id << list(authority_ids)):
+                authorities[(authority_type, authority.id)] = authority
+
+        for cert in chunk:
+            authority = authorities.get((cert.authority_type, cert.authority_id), None)
+            if authority is not None:
+                cert.authority = authority
+            yield cert
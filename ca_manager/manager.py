@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import hashlib
+from datetime import datetime
+from itertools import islice
 import os
 import os.path
-import shutil
 import subprocess
+import time
 
 from playhouse.gfk import *
 
-from .lookup import CALookup, RequestLookup, CertificateLookup
+from .agent import current_agent
+from .crypto import native_available
+from .files import file_lock, link_atomic, shard_path, symlink_atomic
+from .lookup import CALookup, RequestLookup, CertificateLookup, attach_authorities, filter_certificates
 
 from .models.ssh import SSHAuthority
 from .models.ssl import SSLAuthority
-from .models.certificate import Certificate
+from .models.certificate import Certificate, REVOCATION_REASONS
+from .models.customModel import custom_db, retry_on_busy
+from .models.request import REUSABLE_KEY_TYPES, REUSE_INDEX_LOCK_PATH, REUSE_INDEX_PATH, reuse_hash
 
 from .paths import *
 
@@ -34,10 +40,16 @@ class CAManager(object):
         self.request = RequestLookup()
         self.certificate = CertificateLookup()
 
-        # Create tables
-        SSHAuthority.create_table(fail_silently=True)
-        SSLAuthority.create_table(fail_silently=True)
-        Certificate.create_table(fail_silently=True)
+        # Create tables, or add the missing columns
+        SSHAuthority.sync_table()
+        SSLAuthority.sync_table()
+        Certificate.sync_table()
+
+        # revoked before the sequences were stored, the next update
+        # of the revocation lists publishes them again
+        Certificate.update(revocation_sequence=1).where(
+                (Certificate.revoked == True) & (Certificate.revocation_sequence >> None)
+                ).execute()
 
     @property
     def ssh_ca_dir(self):
@@ -87,9 +99,7 @@ def sign_request(ca_manager, request_id, authority_id):
     except IndexError:
         print("Could not find request '%d'" % request_id)
 
-    h = hashlib.sha256()
-    h.update(request.key_data.encode('utf-8'))
-    print("Request hash: %s" % h.hexdigest())
+    print("Request hash: %s" % request.key_hash)
 
     print("You are about to sign the following request:\n  %s\nwith the following CA:\n  %s"%(request, authority))
     confirm = input('Proceed? (type yes)> ')
@@ -101,11 +111,268 @@ def sign_request(ca_manager, request_id, authority_id):
         cert_path = authority.sign(request)
         del ca_manager.request[request_id]
 
-        shutil.copy(cert_path, os.path.join(RESULTS_PATH, request.req_id))
+        publish_result(cert_path, request.req_id)
     except subprocess.CalledProcessError:
         print('Could not sign certificate request')
 
 
+def signs_in_parallel(authority):
+    """
+    Whether the workers of sign_many can sign with the authority
+    without all asking for its passphrase at the same time
+    """
+    # load_private_key asks for it once, the other workers wait
+    if authority.signer == 'native' and native_available():
+        return True
+
+    # or the signing agent holds the unlocked key
+    agent = current_agent()
+    return agent is not None and agent.use(authority.path) is not None
+
+
+def sign_requests(ca_manager, requests, authority, workers=4):
+    """
+    Sign a batch of requests with a single authority, publish the
+    results and report the requests that could not be signed
+    """
+    if not signs_in_parallel(authority):
+        # ssh-keygen and openssl would all ask for the passphrase at
+        # once, they ask for it once per request as in sign_request
+        workers = 1
+
+    results = authority.sign_many(requests, workers)
+
+    for request, result in results:
+        if isinstance(result, Exception):
+            print("Could not sign request '%s': %s" % (request.req_id, result))
+            continue
+
+        del ca_manager.request[request.req_id]
+        publish_result(result, request.req_id)
+
+    return results
+
+
+def publish_result(cert_path, request_id):
+    """
+    Place a signed certificate in RESULTS_PATH with an atomic
+    rename, so ca-server never reads a partially written file, and
+    index it for the reuseExisting requests
+    """
+    link_atomic(cert_path, shard_path(RESULTS_PATH, request_id))
+
+    # read holding the lock: a revocation committed meanwhile
+    # withdraws the link once it is written
+    with file_lock(REUSE_INDEX_LOCK_PATH):
+        cert = Certificate.select().where(Certificate.cert_id == request_id).first()
+        if cert is not None:
+            _publish_reusable(cert)
+
+
+def publish_reusable():
+    """
+    Index for the reuseExisting requests the valid certificates
+    issued before publish_result did, return how many were published
+    """
+    query = Certificate.select().where(
+            (Certificate.key_type << REUSABLE_KEY_TYPES) &
+            (Certificate.revoked == False) &
+            (Certificate.not_after > datetime.now())
+            )
+    published = 0
+
+    with file_lock(REUSE_INDEX_LOCK_PATH):
+        # the one expiring last is left in the index
+        for cert in query.order_by(Certificate.not_after).iterator():
+            published += _publish_reusable(cert)
+
+    return published
+
+
+def _reuse_path(cert):
+    return os.path.join(REUSE_INDEX_PATH, reuse_hash(cert.key_type, cert.receiver, cert.key_fingerprint))
+
+
+def _publish_reusable(cert):
+    if cert.key_type not in REUSABLE_KEY_TYPES or cert.revoked or cert.not_after is None:
+        return False
+
+    symlink_atomic('%s:%d' % (cert.cert_id, time.mktime(cert.not_after.timetuple())), _reuse_path(cert))
+    return True
+
+
+def _withdraw_reusable(certs):
+    with file_lock(REUSE_INDEX_LOCK_PATH):
+        for cert in certs:
+            path = _reuse_path(cert)
+            try:
+                # an other certificate of the same key may have replaced it
+                if os.readlink(path).split(':')[0] == cert.cert_id:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+def migrate_layout(levels=SHARD_LEVELS):
+    """
+    Move the files of REQUESTS_PATH, OUTPUT_PATH and RESULTS_PATH
+    to the layout with the given levels of sub directories and
+    update the certificate paths in the database
+
+    Request keys left in OUTPUT_PATH by older versions, next to
+    their certificate, are removed on the way
+    """
+    moved = {}
+
+    for directory in (REQUESTS_PATH, OUTPUT_PATH, RESULTS_PATH):
+        for dirpath, dirnames, filenames in os.walk(directory, topdown=False):
+            # leave alone the hidden directories, as the index of the requests
+            if os.path.relpath(dirpath, directory).startswith('.') and dirpath != directory:
+                continue
+
+            for name in filenames:
+                # skip the files being written
+                if name.startswith('.'):
+                    continue
+
+                path = os.path.join(dirpath, name)
+
+                if directory == OUTPUT_PATH and name.endswith('.pub') and not name.endswith('-cert.pub'):
+                    if name[:-len('.pub')] + '-cert.pub' in filenames:
+                        os.unlink(path)
+                        continue
+
+                target = shard_path(directory, name, levels)
+                if target == path:
+                    continue
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.rename(path, target)
+                moved[path] = target
+
+            # drop the sub directories left empty
+            if dirpath != directory and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    with custom_db.atomic():
+        for old_path, new_path in moved.items():
+            if old_path.startswith(OUTPUT_PATH):
+                Certificate.update(path=new_path).where(Certificate.path == old_path).execute()
+
+    return len(moved)
+
+
+def backfill_expiry():
+    """
+    Fill the validity period of the certificates issued before it was
+    stored, and the serial of the SSL ones issued with -CAcreateserial,
+    reading them from the certificate files
+
+    Return the number of certificates updated and the ones that could
+    not be read
+    """
+    # the SSL certificates issued since store their serial
+    query = Certificate.select().where(
+            (Certificate.not_after >> None) |
+            ((Certificate.authority_type == SSLAuthority._meta.db_table) & (Certificate.issued_serial >> None))
+            )
+    changes, failed = [], []
+
+    # the files are read before the transaction, ssh-keygen
+    # and openssl never run holding the write lock
+    for cert in attach_authorities(list(query)):
+        try:
+            not_before, not_after = cert.authority.certificate_dates(cert.path)
+            serial = cert.authority.certificate_serial(cert.path)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            failed.append(cert)
+            continue
+
+        values = {}
+        if cert.not_after is None:
+            values.update(not_before=not_before, not_after=not_after)
+        if serial is not None:
+            values.update(issued_serial='%X' % serial)
+        changes.append((cert.id, values))
+
+    _save_backfill(changes)
+    return len(changes), failed
+
+
+@retry_on_busy
+def _save_backfill(changes):
+    with custom_db.atomic():
+        for cert_id, values in changes:
+            Certificate.update(**values).where(Certificate.id == cert_id).execute()
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@retry_on_busy
+def revoke_certificates(reason='unspecified', cert_ids=None, chunk_size=500, **filters):
+    """
+    Revoke in a single transaction the certificates with the given
+    ids, or all the ones matching the filters of
+    lookup.filter_certificates
+
+    Return the number of certificates revoked, of the ones already
+    revoked and the list of the ids not found
+    """
+    if reason not in REVOCATION_REASONS:
+        raise ValueError("Unknown revocation reason '%s'" % reason)
+
+    if not cert_ids and not any(value is not None for value in filters.values()):
+        raise ValueError('Refusing to revoke every certificate, give ids or filters')
+
+    now = datetime.now()
+    revoked, already_revoked, unknown = 0, 0, []
+
+    def matching(query, chunk):
+        query = filter_certificates(query, **filters)
+        if chunk is not None:
+            query = query.where(Certificate.cert_id << chunk)
+        return query
+
+    # ids are matched a chunk at a time, to stay below
+    # the limit of parameters of a query
+    chunks = _chunks(cert_ids, chunk_size) if cert_ids else [None]
+
+    with custom_db.atomic():
+        # the revocation lists publish the sequences above their last
+        # one, a concurrent revocation taking the same sequence fails
+        # to commit and is retried
+        sequence = (Certificate.select(fn.MAX(Certificate.revocation_sequence)).scalar() or 0) + 1
+
+        for chunk in chunks:
+            if chunk is not None:
+                known = set(cert_id for cert_id, in Certificate.select(Certificate.cert_id).where(Certificate.cert_id << chunk).tuples())
+                unknown += [cert_id for cert_id in chunk if cert_id not in known]
+
+            already_revoked += matching(Certificate.select(), chunk).where(Certificate.revoked == True).count()
+
+            revoked += matching(Certificate.update(
+                    revoked=True,
+                    revocation_date=now,
+                    revocation_reason=reason,
+                    revocation_sequence=sequence,
+                    ), chunk).where(Certificate.revoked == False).execute()
+
+    # ca-server no longer sends them again
+    _withdraw_reusable(Certificate.select().where(
+            (Certificate.revocation_sequence == sequence) &
+            (Certificate.key_type << REUSABLE_KEY_TYPES)
+            ).iterator())
+
+    return revoked, already_revoked, unknown
+
+
 if __name__ == '__main__':
     from shell import CAManagerShell
 
@@ -114,6 +381,7 @@ if __name__ == '__main__':
         REQUESTS_PATH,
         OUTPUT_PATH,
         RESULTS_PATH,
+        REVOCATION_PATH,
         ])
 
     ca_manager = CAManager(MANAGER_PATH)
@@ -3,13 +3,20 @@
 
 from playhouse.gfk import *
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import count
 
+import logging
 import os
 import os.path
+import subprocess
+import threading
 
-from .customModel import CustomModel
+from .customModel import CustomModel, custom_db, retry_on_busy
 from .certificate import Certificate
+from ..files import file_lock, write_atomic
 
 from ..paths import *
 
@@ -17,13 +24,42 @@ __doc__ = """
 Module of base classes to handle authorities
 """
 
+# warnings of the signing code, see policy.open_log
+logger = logging.getLogger('signing')
+
+# authority models, by table name
+authority_registry = OrderedDict()
+
+
+def register_authority(model):
+    """
+    Class decorator making an authority type known to the lookups
+    """
+    authority_registry[model._meta.db_table] = model
+    return model
+
+
+def staged_path(path, serial):
+    """
+    Hidden path a certificate is written to before it is saved,
+    two signers of the same request never share it
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.%d' % (name, serial))
+
 
 class Authority(CustomModel):
 
     signed_certificates = ReverseGFK(Certificate, 'authority_type', 'authority_id')
 
+    # bumped whenever an authority is saved in this process
+    generation = 0
+
     request_allowed = []
 
+    # engines able to sign for this authority, the first is the default
+    signers = ['external', ]
+
     # data stored in the database
     active = BooleanField()
 
@@ -49,9 +85,24 @@ class Authority(CustomModel):
             help_text='is root authority?',
             )
 
+    signer = CharField(
+            default='external',
+            help_text='engine used to sign certificates',
+            )
+
     def __bool__(self):
         return os.path.exists(self.path)
 
+    def save(self, *args, **kwargs):
+        result = super(Authority, self).save(*args, **kwargs)
+        Authority.generation += 1
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super(Authority, self).delete_instance(*args, **kwargs)
+        Authority.generation += 1
+        return result
+
     @property
     def path(self):
         return os.path.join(MANAGER_PATH, self.ca_id)
@@ -59,32 +110,234 @@ class Authority(CustomModel):
     def generate(self):
         raise NotImplementedError()
 
+    @retry_on_busy
+    def reserve_serials(self, count=1):
+        """
+        Atomically take count consecutive serial numbers
+        from the database, return the first one
+        """
+        model = type(self)
+
+        with custom_db.atomic():
+            model.update(
+                    serial=model.serial + count,
+                    ).where(model.id == self.id).execute()
+
+            self.serial = model.select(
+                    model.serial,
+                    ).where(model.id == self.id).scalar()
+
+        return self.serial - count
+
     def sign(self, request):
-        assert type(request) in self.request_allowed
+        (request, result), = self.sign_many([request], workers=1)
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def sign_many(self, requests, workers=4):
+        """
+        Sign the requests on a pool of workers, return a list of
+        (request, result) in the same order, result is either the
+        certificate path or the exception raised while signing
+
+        No transaction is held while signing: the serials are taken
+        before, the certificates are saved after, and the serials of
+        the requests that fail are skipped
+        """
+        requests = list(requests)
+
+        # the file of a certificate already issued is never replaced
+        request_ids = [request.req_id for request in requests]
+        already_issued = set()
+        for start in range(0, len(request_ids), 500):
+            query = Certificate.select(Certificate.cert_id).where(Certificate.cert_id << request_ids[start:start + 500])
+            already_issued.update(cert_id for cert_id, in query.tuples())
+
+        pending = len([request for request in requests if request.req_id not in already_issued])
+        serials = count(self.reserve_serials(pending)) if pending else None
+
+        # the workers are named after the caller, see policy.open_log
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=threading.current_thread().name) as pool:
+            futures = [
+                    None if request.req_id in already_issued else pool.submit(self.issue, request, next(serials))
+                    for request in requests
+                    ]
+
+        issued = []
+        for request, future in zip(requests, futures):
+            if future is None:
+                issued.append((request, ValueError("A certificate was already issued for request '%s'" % request.req_id)))
+                continue
+
+            try:
+                issued.append((request, future.result()))
+            except Exception as e:
+                issued.append((request, e))
+
+        return self.save_certificates(issued)
 
-        # write the key data from the request into
-        # the output folder
-        with open(request.destination, 'w') as stream:
-            stream.write(request.key_data)
+    @retry_on_busy
+    def save_certificates(self, issued):
+        """
+        Save the (request, Certificate or exception) pairs in one
+        transaction, then move the saved certificates in place; a
+        certificate that can not be saved has its staged file removed
+        and the error as the result of its request
+        """
+        results = []
+        saved = []
+
+        with custom_db.atomic():
+            for request, cert in issued:
+                if isinstance(cert, Exception):
+                    results.append((request, cert))
+                    continue
+
+                try:
+                    with custom_db.atomic():
+                        # inserted again when a busy database is retried
+                        cert.save(force_insert=True)
+                except IntegrityError as e:
+                    # cert.path belongs to the row of another signer
+                    staged = staged_path(cert.path, cert.serial_number)
+                    if os.path.exists(staged):
+                        os.unlink(staged)
+                    results.append((request, e))
+                    continue
+
+                saved.append(cert)
+                results.append((request, cert.path))
+
+        # only once the rows are committed, a retry finds
+        # the staged files where it left them
+        for cert in saved:
+            os.rename(staged_path(cert.path, cert.serial_number), cert.path)
+
+        return results
+
+    def issue(self, request, serial):
+        """
+        Sign a single request with the given serial, return
+        the Certificate without saving it
+        """
+        assert type(request) in self.request_allowed
 
         cert = Certificate(
                 authority=self,
                 cert_id=request.req_id,
                 date_issued=datetime.now(),
                 receiver=request.receiver,
-                serial_number=self.serial,
+                key_type=request.key_type,
+                key_fingerprint=request.key_fingerprint,
+                serial_number=serial,
                 path=request.cert_destination,
                 )
 
-        cert.validity_interval = self.generate_certificate(request)
+        certificate, cert.validity_interval = self.generate_certificate(request, serial)
+
+        # moved to cert.path by save_certificates
+        staged = staged_path(cert.path, serial)
+        write_atomic(staged, certificate)
+
+        try:
+            cert.not_before, cert.not_after = self.certificate_dates(staged)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            # the certificate is valid anyway, backfill_expiry can retry
+            logger.warning("Could not read the validity of '%s': %s", cert.path, e)
+
+        return cert
+
+    def update_revocation(self):
+        """
+        Bring the revocation lists published for this authority up
+        to date with the revoked certificates, return True when
+        they changed
+        """
+        return False
+
+    def revoked_certificates(self, since=None, until=None):
+        """
+        Select the certificates of this authority revoked after the
+        revocation sequence since, all of them by default, up to the
+        sequence until
+        """
+        query = Certificate.select().where(
+                (Certificate.authority_type == self._meta.db_table) &
+                (Certificate.authority_id == self.id) &
+                (Certificate.revoked == True)
+                )
+
+        if since is not None:
+            query = query.where(Certificate.revocation_sequence > since)
+        if until is not None:
+            query = query.where(Certificate.revocation_sequence <= until)
+        return query
+
+    def last_revocation_sequence(self):
+        """
+        Sequence of the last committed revocation of a certificate of
+        this authority, the later ones can only get a higher one
+        """
+        return Certificate.select(fn.MAX(Certificate.revocation_sequence)).where(
+                (Certificate.authority_type == self._meta.db_table) &
+                (Certificate.authority_id == self.id)
+                ).scalar() or 0
+
+    @property
+    def revocation_lock_path(self):
+        return os.path.join(REVOCATION_PATH, '.%s.lock' % self.ca_id)
 
-        cert.save()
-        self.serial += 1
-        self.save()
-        return cert.path
+    def revocation_lock(self):
+        """
+        Lock held while signing the revocation lists of this
+        authority, shared by ca-shell and ca-ocsp
+        """
+        return file_lock(self.revocation_lock_path)
 
-    def generate_certificate(self, request):
+    def reload(self, *fields):
+        """
+        Read fields again from the database, another
+        process could have changed them
+        """
+        model = type(self)
+        row = model.select(*fields).where(model.id == self.id).get()
+
+        for field in fields:
+            setattr(self, field.name, getattr(row, field.name))
+
+    def agent_unlock(self, agent, idle_timeout):
+        """
+        Load the private key of this authority into the signing agent
+        """
         raise NotImplementedError()
 
+    def native_unlock(self):
+        """
+        Load the private key of this authority for the native signer
+        """
+        raise NotImplementedError()
+
+    def generate_certificate(self, request, serial):
+        """
+        Return the signed certificate, as bytes, and its validity interval
+        """
+        raise NotImplementedError()
+
+    def certificate_dates(self, path):
+        """
+        Return the (not_before, not_after) datetimes of
+        a certificate issued by this authority
+        """
+        raise NotImplementedError()
+
+    def certificate_serial(self, path):
+        """
+        Return the serial written in a certificate issued by this
+        authority, None when it is always the serial_number
+        """
+        return None
+
     def __repr__(self):
         return ('%s %s (%s), created on %s' % (self.__class__.__name__, self.ca_id, self.name, self.creation_date))
@@ -10,6 +10,19 @@ from .customModel import CustomModel
 
 from ..paths import *
 
+# RFC 5280 revocation reasons
+REVOCATION_REASONS = [
+    'unspecified',
+    'key_compromise',
+    'ca_compromise',
+    'affiliation_changed',
+    'superseded',
+    'cessation_of_operation',
+    'certificate_hold',
+    'privilege_withdrawn',
+    'aa_compromise',
+]
+
 
 class Certificate(CustomModel):
     """
@@ -26,10 +39,12 @@ class Certificate(CustomModel):
                 )
 
     date_issued = DateTimeField(
+                index=True,
                 help_text='certificate\'s issue date',
                 )
 
     receiver = CharField(
+                index=True,
                 help_text='hostname or list of user for this certificate',
                 )
 
@@ -37,10 +52,37 @@ class Certificate(CustomModel):
                 help_text='certificate\'s progressive number',
                 )
 
+    issued_serial = CharField(
+                null=True,
+                help_text='hex serial written in a SSL certificate, missing until backfill_expiry reads the older ones',
+                )
+
+    key_type = CharField(
+                null=True,
+                help_text='keyType of the sign request',
+                )
+
+    key_fingerprint = CharField(
+                null=True,
+                index=True,
+                help_text='SHA256 of the signed public key, see request.key_fingerprint',
+                )
+
     validity_interval = CharField(
                 help_text='how long will the certificate be valid',
                 )
 
+    not_before = DateTimeField(
+                null=True,
+                help_text='start of the validity period, read from the certificate',
+                )
+
+    not_after = DateTimeField(
+                null=True,
+                index=True,
+                help_text='end of the validity period, read from the certificate',
+                )
+
     path = CharField(
                 help_text='certificate\'s path on filesystem',
                 )
@@ -51,6 +93,28 @@ class Certificate(CustomModel):
                 help_text='certificate lifecycle state',
                 )
 
+    revocation_date = DateTimeField(
+                null=True,
+                help_text='when the certificate was revoked',
+                )
+
+    revocation_reason = CharField(
+                null=True,
+                help_text='why the certificate was revoked, one of REVOCATION_REASONS',
+                )
+
+    revocation_sequence = IntegerField(
+                null=True,
+                index=True,
+                help_text='number of the transaction revoking the certificate, increasing in commit order',
+                )
+
+    class Meta:
+        indexes = (
+            # OCSP lookups
+            (('authority_type', 'authority_id', 'serial_number'), False),
+        )
+
     def __repr__(self):
         msg = """<%s:%s> for %s
                 signed %s by %s"""
@@ -58,5 +122,16 @@ class Certificate(CustomModel):
                 msg % (self.__class__.__name__, self.cert_id, self.receiver, self.date_issued, self.authority)
                 )
 
+    @staticmethod
+    def real_serial(serial_number, issued_serial):
+        """
+        Serial written in the certificate: the SSL certificates issued
+        with -CAcreateserial got one of openssl, not serial_number, and
+        the SSH ones have no issued_serial
+        """
+        if issued_serial is not None:
+            return int(issued_serial, 16)
+        return serial_number
+
     def __bool__(self):
         return os.path.exists(self.path)
@@ -1,11 +1,138 @@
+from contextlib import contextmanager
+import functools
 from playhouse.gfk import *
+from playhouse.migrate import SqliteMigrator, migrate
 import os
+import time
 
 from ..paths import *
 
-custom_db = SqliteDatabase(os.path.join(MANAGER_PATH, 'ca_manager.db'))
+DATABASE_PATH = os.path.join(MANAGER_PATH, 'ca_manager.db')
+
+# sqlite settings, selected with DATABASE_PROFILE in paths.py
+DATABASE_PROFILES = {
+    # sqlite defaults: rollback journal, full sync
+    'default': {
+        'pragmas': [],
+        'timeout': 5,
+    },
+    # write ahead log, readers never block the signers
+    'performance': {
+        'pragmas': [
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal'),
+            ('cache_size', -64 * 1024),
+            ('mmap_size', 256 * 1024 * 1024),
+            ('temp_store', 'memory'),
+            ('busy_timeout', 30 * 1000),
+        ],
+        'timeout': 30,
+    },
+}
+
+BUSY_RETRIES = 5
+BUSY_RETRY_DELAY = 0.1
+
+custom_db = SqliteDatabase(
+        DATABASE_PATH,
+        pragmas=list(DATABASE_PROFILES[DATABASE_PROFILE]['pragmas']),
+        timeout=DATABASE_PROFILES[DATABASE_PROFILE]['timeout'],
+        )
+
+
+def configure_database(profile=DATABASE_PROFILE, path=DATABASE_PATH):
+    """
+    Use the database in path with the settings of profile,
+    the connection of the current thread is closed
+    """
+    settings = DATABASE_PROFILES[profile]
+
+    # peewee applies the pragmas to every new connection
+    custom_db._pragmas = list(settings['pragmas'])
+    custom_db.init(path, timeout=settings['timeout'])
+
+
+@contextmanager
+def database_connection():
+    """
+    Give a worker thread its own connection, closed when
+    the worker is done, or reuse the one the thread has
+    """
+    if not custom_db.is_closed():
+        yield custom_db
+        return
+
+    custom_db.connect()
+    try:
+        yield custom_db
+    finally:
+        custom_db.close()
+
+
+def retry_on_busy(function):
+    """
+    Run a database operation again when it failed because another
+    connection held the lock past the busy timeout
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        delay = BUSY_RETRY_DELAY
+        for attempt in range(BUSY_RETRIES):
+            try:
+                return function(*args, **kwargs)
+            except OperationalError as e:
+                message = str(e)
+                if 'locked' not in message and 'busy' not in message:
+                    raise
+                if attempt == BUSY_RETRIES - 1:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+    return wrapper
 
 
 class CustomModel(Model):
     class Meta:
         database = custom_db
+
+    @classmethod
+    def sync_table(cls):
+        """
+        Create the table if needed and add the columns
+        and indexes introduced after it was first created
+        """
+        cls.create_table(fail_silently=True)
+
+        table = cls._meta.db_table
+        columns = set(column.name for column in custom_db.get_columns(table))
+
+        migrator = SqliteMigrator(custom_db)
+        operations = [
+                migrator.add_column(table, field.db_column, field)
+                for field in cls._meta.sorted_fields
+                if field.db_column not in columns
+                ]
+
+        # add_column already indexes the new columns
+        indexed = set(tuple(index.columns) for index in custom_db.get_indexes(table))
+        indexed.update((field.db_column, ) for field in cls._meta.sorted_fields if field.db_column not in columns)
+
+        wanted = [
+                ((field.db_column, ), field.unique)
+                for field in cls._meta.sorted_fields
+                if (field.index or field.unique) and not field.primary_key
+                ]
+        wanted += [
+                (tuple(cls._meta.fields[name].db_column for name in names), unique)
+                for names, unique in cls._meta.indexes
+                ]
+
+        operations += [
+                migrator.add_index(table, list(index_columns), unique)
+                for index_columns, unique in wanted
+                if index_columns not in indexed
+                ]
+
+        if operations:
+            with custom_db.atomic():
+                migrate(*operations)
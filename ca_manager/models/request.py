@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
 import os.path
+import re
 
+from ..files import shard_path
 from ..paths import *
 
 __doc__ = """
@@ -10,16 +14,130 @@ Module of classes to handle sign requests
 """
 
 
+# links from the hash of the pending requests to their id
+REQUEST_INDEX_PATH = os.path.join(REQUESTS_PATH, '.index')
+
+# held by ca-server to update a pending request, and
+# by the CA manager to delete one
+REQUEST_INDEX_LOCK_PATH = os.path.join(REQUEST_INDEX_PATH, '.lock')
+
+# links from the hash of what a certificate was issued for to its
+# id and expiry, published by the CA manager for ca-server to send
+# it again without reading the database
+REUSE_INDEX_PATH = os.path.join(RESULTS_PATH, '.reuse')
+
+# held by the CA manager to publish or withdraw a certificate
+REUSE_INDEX_LOCK_PATH = os.path.join(REUSE_INDEX_PATH, '.lock')
+
+# the certificates of the other types grant more than the key:
+# ssh_user principals depend on rootRequested
+REUSABLE_KEY_TYPES = ['ssh_host', 'ssl_host', 'ssl_user', 'ssl_ca', ]
+
+# priorities a client can give to its requests, the
+# higher ones are signed first
+MIN_PRIORITY = -10
+MAX_PRIORITY = 10
+
+# key types whose receiver is a principal of the SSH certificate
+PRINCIPAL_KEY_TYPES = ['ssh_user', 'ssh_host', ]
+
+# list separators and glob metacharacters, a principal with one of
+# them would name more principals to ssh-keygen or to the policy
+RECEIVER_FORBIDDEN = re.compile(r'[\s,*?\[\]]')
+
+
+def key_fingerprint(key_data):
+    """
+    SHA256 of a public key or certificate request, without the
+    comment of SSH keys and the whitespace of PEM documents
+    """
+    if key_data.lstrip().startswith('-----BEGIN'):
+        normalized = ''.join(key_data.split())
+    else:
+        normalized = ' '.join(key_data.split()[:2])
+
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def valid_receiver(key_type, receiver):
+    """
+    Whether the receiver of an SSH request is a single principal,
+    the names of the SSL requests are not restricted
+    """
+    if key_type not in PRINCIPAL_KEY_TYPES:
+        return True
+
+    return isinstance(receiver, str) and receiver != '' and RECEIVER_FORBIDDEN.search(receiver) is None
+
+
+def request_hash(key_type, receiver, key_data, root_requested=False):
+    """
+    Hash of what a request asks, equal for the
+    submissions of the same request
+    """
+    content = json.dumps([key_type, receiver, key_fingerprint(key_data), bool(root_requested)])
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def reuse_hash(key_type, receiver, fingerprint):
+    """
+    Hash of what a certificate was issued for, the
+    key given by its key_fingerprint
+    """
+    content = json.dumps([key_type, receiver, fingerprint])
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def parse_queue_cursor(cursor):
+    """
+    Queue key of the cursor printed by SignRequest.queue_cursor,
+    raise ValueError when it is not valid
+    """
+    priority, timestamp, request_id = cursor.split(':', 2)
+
+    return (-int(priority), float(timestamp), request_id)
+
+
 class SignRequest(object):
+    # keyType of the requests of this class
+    key_type = None
+
     def __init__(self, req_id):
         self.req_id = req_id
+        self.submissions = 1
+        self.priority = 0
+        self.submitted_at = None
 
     def __repr__(self):
-        return ('%s %s with fields: %s' % (self.__class__.__name__, self.req_id, self.fields))
+        details = ''
+        if self.priority:
+            details += ', priority %d' % self.priority
+        if self.submissions > 1:
+            details += ', submitted %d times' % self.submissions
+        if self.submitted_at is not None:
+            details += ', waiting since %s' % self.submitted_at.replace(microsecond=0)
+
+        return ('%s %s with fields: %s%s' % (self.__class__.__name__, self.req_id, self.fields, details))
 
     def __bool__(self):
         return os.path.exists(self.path)
 
+    @property
+    def queue_key(self):
+        """
+        Position in the queue: higher priority first,
+        then the oldest submission
+        """
+        timestamp = self.submitted_at.timestamp() if self.submitted_at is not None else 0.0
+        return (-self.priority, timestamp, self.req_id)
+
+    @property
+    def queue_cursor(self):
+        priority, timestamp, request_id = self.queue_key
+        return '%d:%r:%s' % (-priority, timestamp, request_id)
+
     @property
     def name(self):
         raise NotImplementedError()
@@ -30,15 +148,11 @@ class SignRequest(object):
 
     @property
     def path(self):
-        return os.path.join(REQUESTS_PATH, self.req_id)
-
-    @property
-    def destination(self):
-        return os.path.join(OUTPUT_PATH, self.req_id + '.pub')
+        return shard_path(REQUESTS_PATH, self.req_id)
 
     @property
     def cert_destination(self):
-        return os.path.join(OUTPUT_PATH, self.req_id + '-cert.pub')
+        return shard_path(OUTPUT_PATH, self.req_id + '-cert.pub')
 
     @property
     def fields(self):
@@ -49,3 +163,18 @@ class SignRequest(object):
     @property
     def receiver(self):
         raise NotImplementedError()
+
+    @property
+    def key_hash(self):
+        h = hashlib.sha256()
+        h.update(self.key_data.encode('utf-8'))
+        return h.hexdigest()
+
+    @property
+    def key_fingerprint(self):
+        return key_fingerprint(self.key_data)
+
+    @property
+    def index_path(self):
+        digest = request_hash(self.key_type, self.receiver, self.key_data, getattr(self, 'root_requested', False))
+        return os.path.join(REQUEST_INDEX_PATH, digest)
@@ -3,16 +3,27 @@
 
 from playhouse.gfk import *
 
+from datetime import datetime
+import logging
 import os.path
+import re
+import shutil
 import subprocess
 
-from .authority import Authority
+from .authority import Authority, register_authority
 from .certificate import Certificate
 from .request import SignRequest
+from ..agent import current_agent
+from ..crypto import sign_ssh_certificate, ssh_certificate_dates, unlock_private_key, NativeSigningError
+from ..files import staging_directory, write_atomic
 from ..paths import *
 
+logger = logging.getLogger('signing')
+
 
 class UserSSHRequest(SignRequest):
+    key_type = 'ssh_user'
+
     def __init__(self, req_id, user_name, root_requested, key_data):
         super(UserSSHRequest, self).__init__(req_id)
 
@@ -37,6 +48,7 @@ class UserSSHRequest(SignRequest):
 
 
 class HostSSHRequest(SignRequest):
+    key_type = 'ssh_host'
 
     def __init__(self, req_id, host_name, key_data):
         super(HostSSHRequest, self).__init__(req_id)
@@ -59,15 +71,33 @@ class HostSSHRequest(SignRequest):
         return self.host_name
 
 
+@register_authority
 class SSHAuthority(Authority):
 
     request_allowed = [UserSSHRequest, HostSSHRequest, ]
 
+    signers = ['external', 'native', ]
+
     key_algorithm = 'ed25519'
 
     user_validity = '+52w'
     host_validity = '+52w'
 
+    krl_version = IntegerField(
+                default=0,
+                help_text='version of the key revocation list',
+                )
+
+    krl_updated = DateTimeField(
+                null=True,
+                help_text='when the key revocation list was last updated',
+                )
+
+    krl_sequence = IntegerField(
+                default=0,
+                help_text='revocations up to this sequence are in the key revocation list',
+                )
+
     def __bool__(self):
         """
         Check if key pair already exists
@@ -93,38 +123,185 @@ class SSHAuthority(Authority):
         else:
             raise ValueError('A CA with the same id already exists')
 
-    def generate_certificate(self, request):
+    def agent_unlock(self, agent, idle_timeout):
+        agent.unlock_ssh_key(self.ca_id, self.path, idle_timeout)
+
+    def native_unlock(self):
+        unlock_private_key(self.path, 'ssh')
+
+    def generate_certificate(self, request, serial):
         """
         Sign a *SSHRequest with this certification authority
         """
 
-        pub_key_path = request.destination
-
-        ca_private_key = self.path
-
         if type(request) == UserSSHRequest:
-            login_names = [request.user_name, ]
+            key_id = 'user_%s' % request.receiver
+            principals = [request.user_name, ]
             if request.root_requested:
-                login_names.append('root')
-
-            subprocess.check_output(['ssh-keygen',
-                                     '-s', ca_private_key,
-                                     '-I', 'user_%s' % request.receiver,
-                                     '-n', ','.join(login_names),
-                                     '-V', self.user_validity,
-                                     '-z', str(self.serial),
-                                     pub_key_path])
+                principals.append('root')
             validity_interval = self.user_validity
+            host = False
 
         elif type(request) == HostSSHRequest:
-            subprocess.check_output(['ssh-keygen',
-                                     '-s', ca_private_key,
-                                     '-I', 'host_%s' % request.receiver.replace('.', '_'),
-                                     '-h',
-                                     '-n', request.host_name,
-                                     '-V', self.host_validity,
-                                     '-z', str(self.serial),
-                                     pub_key_path])
+            key_id = 'host_%s' % request.receiver.replace('.', '_')
+            principals = [request.host_name, ]
             validity_interval = self.host_validity
+            host = True
+
+        if self.signer == 'native':
+            try:
+                certificate = sign_ssh_certificate(
+                        self.path,
+                        request.key_data,
+                        key_id,
+                        principals,
+                        serial,
+                        validity_interval,
+                        host=host,
+                        )
+            except NativeSigningError as e:
+                logger.warning('Native signing not possible (%s), using ssh-keygen', e)
+            else:
+                return certificate, validity_interval
+
+        agent = current_agent()
+        if agent is not None and agent.use(self.path) is not None:
+            # the private key is held by the signing agent
+            command = ['ssh-keygen', '-U', '-s', '%s.pub' % self.path, ]
+            environment = agent.environment
+        else:
+            command = ['ssh-keygen', '-s', self.path, ]
+            environment = None
+
+        command += ['-I', key_id,
+                    '-n', ','.join(principals),
+                    '-V', validity_interval,
+                    '-z', str(serial),
+                    ]
+        if host:
+            command.append('-h')
+
+        # ssh-keygen only works on files, keep them in memory
+        with staging_directory() as staging_path:
+            pub_key_path = os.path.join(staging_path, 'key.pub')
+            with open(pub_key_path, 'w') as stream:
+                stream.write(request.key_data)
+
+            subprocess.check_output(command + [pub_key_path], env=environment)
+
+            with open(os.path.join(staging_path, 'key-cert.pub'), 'rb') as stream:
+                certificate = stream.read()
+
+        return certificate, validity_interval
+
+    @property
+    def krl_path(self):
+        return os.path.join(REVOCATION_PATH, '%s.krl' % self.ca_id)
+
+    def update_revocation(self):
+        return self.update_krl()
+
+    def update_krl(self):
+        """
+        Add the certificates revoked since the last update to the key
+        revocation list, the first time it is built from all of them
+        """
+        with self.revocation_lock():
+            return self._update_krl()
+
+    def _update_krl(self):
+        self.reload(SSHAuthority.krl_version, SSHAuthority.krl_updated, SSHAuthority.krl_sequence)
+        started = datetime.now()
+        until = self.last_revocation_sequence()
+
+        full = self.krl_updated is None or not os.path.exists(self.krl_path)
+        if not full and until == self.krl_sequence:
+            return False
+
+        query = self.revoked_certificates(None if full else self.krl_sequence, until)
+        revoked = list(query.select(Certificate.serial_number, Certificate.path).tuples())
+
+        version = self.krl_version + 1
+
+        with staging_directory() as staging_path:
+            spec_path = os.path.join(staging_path, 'revoked')
+            krl_path = os.path.join(staging_path, 'krl')
+
+            # key ids are shared by the certificates of a receiver,
+            # only the serials identify the revoked ones
+            with open(spec_path, 'w') as stream:
+                for serial, path in revoked:
+                    if serial != 0:
+                        stream.write('serial: %d\n' % serial)
+                        continue
+
+                    # a KRL can't hold serial 0, given to the first
+                    # certificate of the older authorities, its key is
+                    # revoked instead
+                    try:
+                        fingerprint = self.certified_key_fingerprint(path)
+                    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                        logger.warning("Could not revoke the serial 0 certificate '%s': %s", path, e)
+                        continue
+                    stream.write('hash: %s\n' % fingerprint)
+
+            command = ['ssh-keygen',
+                       '-k',
+                       '-f', krl_path,
+                       '-s', '%s.pub' % self.path,
+                       '-z', str(version),
+                       ]
+            if not full:
+                shutil.copy(self.krl_path, krl_path)
+                command.append('-u')
+
+            subprocess.check_output(command + [spec_path], stderr=subprocess.STDOUT)
+
+            with open(krl_path, 'rb') as stream:
+                krl = stream.read()
+
+        write_atomic(self.krl_path, krl)
+
+        self.krl_version = version
+        self.krl_updated = started
+        self.krl_sequence = until
+        # leave the serial alone, it could be reserved meanwhile
+        self.save(only=[SSHAuthority.krl_version, SSHAuthority.krl_updated, SSHAuthority.krl_sequence])
+
+        return True
+
+    def certified_key_fingerprint(self, path):
+        """
+        SHA256 fingerprint of the key certified by the certificate
+        in path, as printed by ssh-keygen
+        """
+        output = subprocess.check_output(['ssh-keygen', '-l', '-E', 'sha256', '-f', path]).decode('utf-8')
+
+        match = re.search(r'\b(SHA256:\S+)', output)
+        if not match:
+            raise ValueError('Could not parse the ssh-keygen output')
+        return match.group(1)
+
+    def certificate_dates(self, path):
+        """
+        Read the validity period of a certificate issued by this authority
+        """
+        try:
+            with open(path, 'rb') as stream:
+                return ssh_certificate_dates(stream.read())
+        except NativeSigningError:
+            pass
+
+        output = subprocess.check_output(['ssh-keygen', '-L', '-f', path]).decode('utf-8')
+
+        # 'Valid: from X to Y', 'Valid: after X', 'Valid: before Y' or 'Valid: forever'
+        match = re.search(r'Valid: (?:from (\S+) to (\S+)|after (\S+)|before (\S+)|forever)', output)
+        if not match:
+            raise ValueError('Could not read the validity of %s' % path)
+
+        not_before, not_after = match.group(1) or match.group(3), match.group(2) or match.group(4)
 
-        return validity_interval
+        return tuple(
+                datetime.strptime(date, '%Y-%m-%dT%H:%M:%S') if date else None
+                for date in (not_before, not_after)
+                )
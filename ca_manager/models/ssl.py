@@ -3,19 +3,29 @@
 
 from playhouse.gfk import *
 
+import calendar
+from datetime import datetime, timedelta
+import logging
 import os
 from inspect import getsourcefile
 import subprocess
 
-from .authority import Authority
+from .authority import Authority, register_authority
 from .certificate import Certificate
 from .request import SignRequest
+from ..agent import current_agent
+from ..crypto import sign_crl, sign_x509_certificate, unlock_private_key, x509_certificate_dates, x509_certificate_serial, NativeSigningError
+from ..files import read_cached, staging_directory, write_atomic
 from ..paths import *
 
 import json
 
+logger = logging.getLogger('signing')
+
 
 class HostSSLRequest(SignRequest):
+    key_type = 'ssl_host'
+
     def __init__(self, req_id, host_name, key_data):
         super().__init__(req_id)
 
@@ -38,6 +48,8 @@ class HostSSLRequest(SignRequest):
 
 
 class UserSSLRequest(SignRequest):
+    key_type = 'ssl_user'
+
     def __init__(self, req_id, user_name, key_data):
         super().__init__(req_id)
 
@@ -60,6 +72,8 @@ class UserSSLRequest(SignRequest):
 
 
 class CASSLRequest(SignRequest):
+    key_type = 'ssl_ca'
+
     def __init__(self, req_id, ca_name, key_data):
         super().__init__(req_id)
 
@@ -81,6 +95,7 @@ class CASSLRequest(SignRequest):
         return self.ca_name
 
 
+@register_authority
 class SSLAuthority(Authority):
     request_allowed = [
         HostSSLRequest,
@@ -88,6 +103,8 @@ class SSLAuthority(Authority):
         CASSLRequest,
     ]
 
+    signers = ['external', 'native', ]
+
     ca_key_algorithm = 'des3'
     key_length = '4096'
 
@@ -96,6 +113,48 @@ class SSLAuthority(Authority):
     ca_validity = '1825'
     cert_validity = '365'
 
+    # a CRL is valid for crl_days, and signed again when less than
+    # crl_refresh is left, as default_crl_days in openssl.cnf
+    crl_days = 30
+    crl_refresh = timedelta(days=1)
+    # a full CRL replaces the delta CRL past this many entries
+    delta_crl_limit = 1000
+
+    crl_number = IntegerField(
+                default=0,
+                help_text='number of the last CRL, full or delta',
+                )
+
+    crl_base_number = IntegerField(
+                default=0,
+                help_text='number of the last full CRL',
+                )
+
+    crl_base_updated = DateTimeField(
+                null=True,
+                help_text='when the last full CRL was signed',
+                )
+
+    crl_updated = DateTimeField(
+                null=True,
+                help_text='when the last full or delta CRL was signed',
+                )
+
+    crl_base_sequence = IntegerField(
+                default=0,
+                help_text='revocations up to this sequence are in the full CRL',
+                )
+
+    crl_sequence = IntegerField(
+                default=0,
+                help_text='revocations up to this sequence are in the full or delta CRL',
+                )
+
+    crl_next_update = DateTimeField(
+                null=True,
+                help_text='when the published CRLs expire',
+                )
+
     def generate(self):
         if os.path.exists(self.path):
             raise ValueError('A CA with the same id and type already exists')
@@ -147,7 +206,19 @@ class SSLAuthority(Authority):
         with open(self.path + '.serial', 'w') as stream:
             stream.write(str(0))
 
-    def generate_certificate(self, request):
+    def issue(self, request, serial):
+        cert = super().issue(request, serial)
+        # the serial given to -set_serial or the native signer
+        cert.issued_serial = '%X' % serial
+        return cert
+
+    def agent_unlock(self, agent, idle_timeout):
+        agent.unlock_ssl_key(self.ca_id, self.path, idle_timeout)
+
+    def native_unlock(self):
+        unlock_private_key(self.path, 'ssl')
+
+    def generate_certificate(self, request, serial):
         """
         Sign a *SSLRequest with this certification authority
         """
@@ -155,25 +226,206 @@ class SSLAuthority(Authority):
         if not os.path.exists('%s.pub' % self.path) and not self.isRoot:
             raise ValueError("The CA certificate '%s.pub' doesn't exists yet" % self.path)
 
-        pub_key_path = request.destination
-        cert_path = request.cert_destination
+        certificate = None
+        if self.signer == 'native':
+            try:
+                certificate = sign_x509_certificate(
+                        self.path,
+                        '%s.pub' % self.path,
+                        request.key_data,
+                        serial,
+                        self.ca_validity,
+                        is_ca=type(request) == CASSLRequest,
+                        digest=self.key_algorithm,
+                        ocsp_url=OCSP_URL,
+                        )
+            except NativeSigningError as e:
+                logger.warning('Native signing not possible (%s), using openssl', e)
+
+        if certificate is None:
+            ca_private_key = self.path
+
+            agent = current_agent()
+            if agent is not None:
+                key = agent.use(self.path)
+                if key is not None:
+                    # already decrypted by the signing agent
+                    ca_private_key = key.path
+
+            command = ['openssl',
+                       'x509',
+                       '-req',
+                       '-days', self.ca_validity,
+                       '-CA', '%s.pub' % self.path,
+                       '-CAkey', ca_private_key,
+                       '-set_serial', str(serial),
+                       '-%s' % self.key_algorithm]
+
+            with staging_directory() as staging_path:
+                if OCSP_URL:
+                    extensions_path = os.path.join(staging_path, 'extensions.cnf')
+                    with open(extensions_path, 'w') as stream:
+                        stream.write('authorityInfoAccess = OCSP;URI:%s\n' % OCSP_URL)
+                    command += ['-extfile', extensions_path]
+
+                # the request goes in through stdin and the
+                # certificate comes out through stdout
+                certificate = subprocess.check_output(command, input=request.key_data.encode('utf-8'))
 
-        with open(pub_key_path, 'w') as stream:
-            stream.write(request.key_data)
+        if not self.isRoot:
+            certificate += read_cached('%s.pub' % self.path)
+        return certificate, self.ca_validity
 
-        subprocess.check_output(['openssl',
-                                 'x509',
-                                 '-req',
-                                 '-days', self.ca_validity,
-                                 '-in', pub_key_path,
-                                 '-CA', '%s.pub' % self.path,
-                                 '-CAkey', self.path,
-                                 '-CAcreateserial',
-                                 '-out', cert_path,
-                                 '-%s' % self.key_algorithm])
+    @property
+    def crl_path(self):
+        return os.path.join(REVOCATION_PATH, '%s.crl' % self.ca_id)
 
-        if not self.isRoot:
-            with open(cert_path, 'a') as cert_file:
-                with open('%s.pub' % self.path) as ca_cert_file:
-                    cert_file.writelines(ca_cert_file.readlines())
-        return self.ca_validity
+    @property
+    def delta_crl_path(self):
+        return os.path.join(REVOCATION_PATH, '%s-delta.crl' % self.ca_id)
+
+    def update_revocation(self):
+        return self.update_crl()
+
+    def update_crl(self, force=False):
+        """
+        Sign new CRLs only when certificates were revoked or the
+        published ones are about to expire: a delta CRL for the
+        revocations since the last full CRL, a full CRL when it
+        expires or the delta grows too large
+
+        ca-shell and ca-ocsp both call it, the CRL numbers are
+        taken holding the revocation lock of the authority
+        """
+        with self.revocation_lock():
+            return self._update_crl(force)
+
+    def _update_crl(self, force):
+        self.reload(
+                SSLAuthority.crl_number,
+                SSLAuthority.crl_base_number,
+                SSLAuthority.crl_base_updated,
+                SSLAuthority.crl_updated,
+                SSLAuthority.crl_next_update,
+                SSLAuthority.crl_base_sequence,
+                SSLAuthority.crl_sequence,
+                )
+        now = datetime.now()
+        until = self.last_revocation_sequence()
+
+        expiring = self.crl_next_update is None or self.crl_next_update - self.crl_refresh <= now
+        missing = self.crl_base_updated is None or not os.path.exists(self.crl_path)
+        changed = until != self.crl_sequence
+
+        if not (force or expiring or missing or changed):
+            return False
+
+        delta = self.revoked_certificates(self.crl_base_sequence, until) if not missing else None
+        full = force or expiring or missing or delta.count() > self.delta_crl_limit
+
+        query = self.revoked_certificates(None if full else self.crl_base_sequence, until)
+        revoked = []
+        for serial_number, issued_serial, revocation_date, reason in query.select(
+                Certificate.serial_number,
+                Certificate.issued_serial,
+                Certificate.revocation_date,
+                Certificate.revocation_reason,
+                ).tuples():
+            serial = Certificate.real_serial(serial_number, issued_serial)
+            # X.509 serials are positive
+            if serial > 0:
+                revoked.append((serial, revocation_date, reason))
+
+        crl_number = self.crl_number + 1
+        next_update = now + timedelta(days=self.crl_days)
+        if not full:
+            # a delta CRL can't outlive its base
+            next_update = self.crl_next_update
+
+        der, pem = sign_crl(
+                self.path,
+                '%s.pub' % self.path,
+                revoked,
+                crl_number,
+                now,
+                next_update,
+                base_crl_number=None if full else self.crl_base_number,
+                digest=self.key_algorithm,
+                )
+
+        if full:
+            write_atomic(self.crl_path, der)
+            write_atomic(self.crl_path + '.pem', pem)
+
+            # the delta of the previous full CRL is now empty
+            for path in (self.delta_crl_path, self.delta_crl_path + '.pem'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+            self.crl_base_number = crl_number
+            self.crl_base_updated = now
+            self.crl_base_sequence = until
+            self.crl_next_update = next_update
+        else:
+            write_atomic(self.delta_crl_path, der)
+            write_atomic(self.delta_crl_path + '.pem', pem)
+
+        self.crl_number = crl_number
+        self.crl_updated = now
+        self.crl_sequence = until
+        # leave the serial alone, it could be reserved meanwhile
+        self.save(only=[
+            SSLAuthority.crl_number,
+            SSLAuthority.crl_base_number,
+            SSLAuthority.crl_base_updated,
+            SSLAuthority.crl_updated,
+            SSLAuthority.crl_next_update,
+            SSLAuthority.crl_base_sequence,
+            SSLAuthority.crl_sequence,
+            ])
+
+        return True
+
+    def certificate_dates(self, path):
+        """
+        Read the validity period of a certificate issued by this authority
+        """
+        try:
+            with open(path, 'rb') as stream:
+                return x509_certificate_dates(stream.read())
+        except NativeSigningError:
+            pass
+
+        output = subprocess.check_output(['openssl',
+                                          'x509',
+                                          '-noout',
+                                          '-startdate',
+                                          '-enddate',
+                                          '-in', path]).decode('utf-8')
+
+        # notBefore=Jan  1 00:00:00 2025 GMT
+        dates = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+
+        return tuple(
+                datetime.fromtimestamp(calendar.timegm(datetime.strptime(' '.join(dates[name].split()), '%b %d %H:%M:%S %Y GMT').utctimetuple()))
+                for name in ('notBefore', 'notAfter')
+                )
+
+    def certificate_serial(self, path):
+        """
+        Read the serial of a certificate issued by this authority
+        """
+        try:
+            with open(path, 'rb') as stream:
+                return x509_certificate_serial(stream.read())
+        except NativeSigningError:
+            pass
+
+        # serial=1A2B...
+        output = subprocess.check_output(['openssl',
+                                          'x509',
+                                          '-noout',
+                                          '-serial',
+                                          '-in', path]).decode('utf-8')
+
+        return int(output.strip().split('=', 1)[1], 16)
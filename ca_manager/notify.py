@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import struct
+import time
+
+__doc__ = """
+Wait for files to be published in a directory, using inotify when
+available and falling back to a polling loop that backs off
+"""
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# results are published with an atomic rename, a file closed
+# after writing is accepted for writers that do not
+WATCH_MASK = IN_MOVED_TO | IN_CLOSE_WRITE
+
+POLL_MIN_DELAY = 0.05
+POLL_MAX_DELAY = 2.0
+
+_event_header = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Minimal ctypes wrapper around the Linux inotify API
+    """
+
+    _libc = None
+
+    def __init__(self):
+        libc = self.libc()
+        if libc is None:
+            raise OSError('inotify is not available')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.watches = {}
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+            except (OSError, AttributeError):
+                return None
+            cls._libc = libc
+        return cls._libc
+
+    def add_watch(self, directory, mask=WATCH_MASK):
+        wd = self.libc().inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', directory)
+        self.watches[wd] = directory
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds for events, return the set of paths
+        touched or None when the kernel queue overflowed
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(None if timeout is None else int(timeout * 1000)):
+            return set()
+
+        paths = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self.watches and name:
+                paths.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watch(directories):
+    """
+    Return an Inotify instance watching the directories,
+    or None if inotify can not be used
+    """
+    try:
+        watcher = Inotify()
+    except OSError:
+        return None
+
+    try:
+        for directory in directories:
+            watcher.add_watch(directory)
+    except OSError:
+        watcher.close()
+        return None
+
+    return watcher
+
+
+def wait_for_files(paths, timeout=None):
+    """
+    Yield each of the paths as soon as it exists, until all of them
+    have been seen or timeout seconds have passed
+    """
+    pending = list(paths)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    directories = set(os.path.dirname(path) for path in pending)
+    for directory in directories:
+        # the sub directories of a sharded layout may not exist yet
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            # open_watch fails and the directory is polled
+            pass
+
+    watcher = open_watch(directories)
+    delay = POLL_MIN_DELAY
+
+    try:
+        # look for files published before the watch was in place
+        touched = None
+
+        while pending:
+            if touched is None:
+                ready = [path for path in pending if os.path.exists(path)]
+            else:
+                ready = [path for path in pending if path in touched and os.path.exists(path)]
+
+            for path in ready:
+                pending.remove(path)
+                yield path
+
+            if not pending:
+                return
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+
+            if watcher is not None:
+                touched = watcher.read(remaining)
+            else:
+                time.sleep(delay if remaining is None else min(delay, remaining))
+                delay = min(delay * 2, POLL_MAX_DELAY)
+                touched = None
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def wait_for_file(path, timeout=None):
+    """
+    Block until path exists, return False if timeout
+    seconds passed before it did
+    """
+    for ready in wait_for_files([path], timeout):
+        return True
+    return False
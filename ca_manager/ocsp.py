@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import os.path
+import signal
+import socketserver
+import sys
+import threading
+from urllib.parse import unquote
+
+from .crypto import load_ocsp_request, ocsp_error, ocsp_issuer_hashes, sign_ocsp_response, NativeSigningError
+from .models.certificate import Certificate
+from .models.customModel import custom_db
+from .models.ssl import SSLAuthority
+from .paths import *
+
+__doc__ = """
+OCSP responder for the SSL authorities: the responses about every
+issued certificate are signed in advance and served from memory, a
+background thread signs again only the ones whose revocation state
+changed or that are about to expire
+
+The same thread keeps the CRLs of the authorities fresh, signing them
+again before their nextUpdate and when certificates are revoked
+"""
+
+logger = logging.getLogger('ocsp_responder')
+
+# how long a response is valid, and how long before
+# its expiration it is signed again
+RESPONSE_VALIDITY = timedelta(days=1)
+RESPONSE_REFRESH = timedelta(hours=6)
+
+# seconds between two checks of the database
+REFRESH_INTERVAL = 60
+
+# maximum size in bytes of an OCSP request
+OCSP_REQUEST_SIZE_LIMIT = 64 * 1024
+
+
+class ResponseCache(object):
+    """
+    Signed OCSP responses, by (issuer_name_hash, issuer_key_hash, serial)
+    """
+
+    def __init__(self):
+        # key: (revocation state, next_update, response)
+        self.responses = {}
+        self.lock = threading.Lock()
+
+        self._data_version = None
+        self._next_expiry = None
+
+    def is_stale(self):
+        # data_version only changes for commits of other connections
+        data_version = custom_db.execute_sql('PRAGMA data_version').fetchone()[0]
+        changed = data_version != self._data_version
+        self._data_version = data_version
+
+        return changed or self._next_expiry is None or self._next_expiry - RESPONSE_REFRESH <= datetime.now()
+
+    def refresh(self):
+        """
+        Sign the responses of new certificates, of the ones whose
+        revocation state changed and of the ones about to expire,
+        return how many were signed
+        """
+        if not self.is_stale():
+            return 0
+
+        now = datetime.now()
+        next_update = now + RESPONSE_VALIDITY
+
+        responses = {}
+        signed = 0
+
+        for authority in SSLAuthority.select():
+            ca_cert_path = '%s.pub' % authority.path
+            if not os.path.exists(ca_cert_path):
+                continue
+
+            name_hash, key_hash = ocsp_issuer_hashes(ca_cert_path)
+
+            # served by the (authority_type, authority_id, serial_number) index
+            query = Certificate.select(
+                    Certificate.serial_number,
+                    Certificate.issued_serial,
+                    Certificate.revoked,
+                    Certificate.revocation_date,
+                    Certificate.revocation_reason,
+                    Certificate.path,
+                    ).where(
+                    (Certificate.authority_type == authority._meta.db_table) &
+                    (Certificate.authority_id == authority.id)
+                    )
+
+            for serial_number, issued_serial, revoked, revocation_date, reason, path in query.tuples().iterator():
+                serial = Certificate.real_serial(serial_number, issued_serial)
+                key = (name_hash, key_hash, serial)
+                state = (revoked, revocation_date, reason)
+
+                cached = self.responses.get(key, None)
+                if cached is not None and cached[0] == state and cached[1] - RESPONSE_REFRESH > now:
+                    responses[key] = cached
+                    continue
+
+                response = sign_ocsp_response(
+                        authority.path,
+                        ca_cert_path,
+                        serial,
+                        revoked,
+                        revocation_date,
+                        reason,
+                        now,
+                        next_update,
+                        cert_path=path,
+                        digest=authority.key_algorithm,
+                        )
+                responses[key] = (state, next_update, response)
+                signed += 1
+
+        with self.lock:
+            self.responses = responses
+        self._next_expiry = min((cached[1] for cached in responses.values()), default=None)
+
+        return signed
+
+    def respond(self, request_data):
+        """
+        Return the DER encoded response to a DER encoded request
+        """
+        try:
+            key = load_ocsp_request(request_data)
+        except ValueError:
+            return ocsp_error('malformed_request')
+
+        with self.lock:
+            cached = self.responses.get(key, None)
+
+        if cached is None:
+            # not issued by one of our authorities
+            return ocsp_error('unauthorized')
+        return cached[2]
+
+
+def refresh_crls():
+    """
+    Sign again the CRLs about to expire or missing the latest
+    revocations, return how many authorities were updated
+    """
+    updated = 0
+
+    for authority in SSLAuthority.select():
+        if not os.path.exists('%s.pub' % authority.path):
+            continue
+
+        try:
+            if authority.update_crl():
+                updated += 1
+        except (OSError, ValueError, NativeSigningError) as e:
+            logger.warning('Could not update the CRL of %s: %s', authority.ca_id, e)
+
+    return updated
+
+
+def refresh_responses(cache, stopped, interval=REFRESH_INTERVAL):
+    custom_db.connect()
+    try:
+        while not stopped.wait(interval):
+            try:
+                signed = cache.refresh()
+                updated = refresh_crls()
+            except Exception:
+                logger.exception('Could not refresh the OCSP responses and the CRLs')
+                continue
+
+            if signed:
+                logger.info('Signed %d OCSP responses', signed)
+            if updated:
+                logger.info('Updated the CRLs of %d authorities', updated)
+    finally:
+        custom_db.close()
+
+
+class OCSPRequestHandler(BaseHTTPRequestHandler):
+    """
+    OCSP over HTTP, as in RFC 6960 appendix A
+    """
+
+    def send_ocsp_response(self, response):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/ocsp-response')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        try:
+            request_data = base64.b64decode(unquote(self.path.lstrip('/')), validate=True)
+        except ValueError:
+            self.send_ocsp_response(ocsp_error('malformed_request'))
+            return
+
+        self.send_ocsp_response(self.server.cache.respond(request_data))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self.send_error(411)
+            return
+
+        if length > OCSP_REQUEST_SIZE_LIMIT:
+            self.send_error(413)
+            return
+
+        self.send_ocsp_response(self.server.cache.respond(self.rfile.read(length)))
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+
+class OCSPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    cache = None
+
+
+def serve(address=OCSP_ADDRESS, port=OCSP_PORT, interval=REFRESH_INTERVAL):
+    """
+    Run the OCSP responder, the passphrases of the CA keys
+    are asked once while signing the first responses
+    """
+    logging.basicConfig(
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            level=logging.INFO,
+            )
+
+    cache = ResponseCache()
+    logger.info('Signed %d OCSP responses', cache.refresh())
+    logger.info('Updated the CRLs of %d authorities', refresh_crls())
+    custom_db.close()
+
+    server = OCSPServer((address, port), OCSPRequestHandler)
+    server.cache = cache
+
+    stopped = threading.Event()
+    refresher = threading.Thread(target=refresh_responses, args=(cache, stopped, interval), daemon=True)
+    refresher.start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    logger.info('OCSP responder listening on %s:%d', address, port)
+    try:
+        server.serve_forever()
+    finally:
+        stopped.set()
+        server.server_close()
+        logger.info('OCSP responder stopped')
@@ -5,7 +5,27 @@ MANAGER_PATH = "/var/lib/ca_manager/private"
 REQUESTS_PATH = "/var/lib/ca_manager/requests"
 OUTPUT_PATH = "/var/lib/ca_manager/outputs"
 RESULTS_PATH = "/var/lib/ca_manager/results"
+REVOCATION_PATH = "/var/lib/ca_manager/revocation"
 REQUEST_USER_HOME = "/home/request"
+SERVER_SOCKET_PATH = "/var/lib/ca_manager/server.sock"
+
+# local OCSP responder started by ca-ocsp, and the URL written in the
+# SSL certificates, None leaves them without OCSP service
+OCSP_ADDRESS = "127.0.0.1"
+OCSP_PORT = 8088
+OCSP_URL = None
+
+# rules of the requests signed without an operator, and the log of
+# every decision taken on them, see ca_manager/policy.py
+AUTOSIGN_POLICY_PATH = "/var/lib/ca_manager/private/autosign.json"
+AUTOSIGN_LOG_PATH = "/var/lib/ca_manager/private/autosign.log"
+
+# levels of hashed sub directories used for requests, outputs and
+# results, 0 keeps them flat, run migrate_layout in ca-shell after a change
+SHARD_LEVELS = 0
+
+# sqlite settings for the database, see DATABASE_PROFILES in models/customModel.py
+DATABASE_PROFILE = "performance"
 
 __doc__ = """
 Paths for directories used by the CA manager
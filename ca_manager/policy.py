@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from fnmatch import fnmatchcase
+import json
+import logging
+import os
+import os.path
+import threading
+
+from .agent import current_agent, start_agent
+from .crypto import native_available, private_key_loaded
+from .lookup import request_types
+from .manager import CAManager, publish_result
+from .models.customModel import database_connection
+from .models.request import REQUEST_INDEX_PATH, valid_receiver
+from .notify import open_watch
+from .paths import *
+
+__doc__ = """
+Sign the requests matching a declarative policy as soon as they are
+queued, without waiting for an operator. The policy is a JSON file:
+
+    {"rules": [
+        {"name": "dc1 hosts", "type": "ssh_host",
+         "receiver": "*.dc1.example.com", "ca": "ssh-host-dc1"},
+        {"name": "admins", "type": "ssh_user",
+         "receiver": ["alice", "bob"], "ca": "ssh-users"}
+    ]}
+
+The first rule whose type and receiver pattern (or list of patterns)
+match a request gives the CA signing it. User requests asking for
+root, or from the user root, are matched only by the rules with
+"rootRequested": true. The requests matching no rule are left to the
+operator, every decision is written to AUTOSIGN_LOG_PATH. A change of the policy file stops
+the auto signer, the operator reviews and starts it again.
+"""
+
+logger = logging.getLogger('autosign')
+
+POLICY_KEYS = ['name', 'type', 'receiver', 'rootRequested', 'ca', ]
+
+# seconds between two scans of the requests when nothing is notified
+RESCAN_INTERVAL = 5
+
+# the keys unlocked for the auto signer outlive the default idle timeout
+UNATTENDED_IDLE_TIMEOUT = 7 * 24 * 60 * 60
+
+# name of the auto signer thread, and prefix of its signing workers
+AUTO_SIGNER_THREAD = 'autosign'
+
+
+def asks_root(request):
+    """
+    Whether a user request would be signed for the root principal,
+    asking for it or naming root as the user
+    """
+    if not hasattr(request, 'root_requested'):
+        return False
+    return bool(request.root_requested) or request.receiver == 'root'
+
+
+class PolicyRule(object):
+
+    def __init__(self, name, key_type, receivers, ca_id, root_allowed=False):
+        self.name = name
+        self.key_type = key_type
+        self.receivers = receivers
+        self.ca_id = ca_id
+        self.root_allowed = root_allowed
+
+    def matches(self, request):
+        if request.key_type != self.key_type:
+            return False
+
+        if asks_root(request) and not self.root_allowed:
+            return False
+
+        # a pattern could match a list of names, or a name with wildcards
+        if not valid_receiver(request.key_type, request.receiver):
+            return False
+
+        return any(fnmatchcase(request.receiver, pattern) for pattern in self.receivers)
+
+    def __repr__(self):
+        return ("Rule '%s': %s requests from %s%s signed by %s" % (
+            self.name,
+            self.key_type,
+            ', '.join(self.receivers),
+            ', root allowed,' if self.root_allowed else '',
+            self.ca_id,
+            ))
+
+
+def load_policy(path=AUTOSIGN_POLICY_PATH):
+    """
+    Read the rules of the policy file, raise ValueError
+    when the file is not valid
+    """
+    with open(path, 'r') as stream:
+        policy = json.load(stream)
+
+    if not isinstance(policy, dict) or not isinstance(policy.get('rules', None), list):
+        raise ValueError("The policy must be an object with a list of 'rules'")
+
+    rules = []
+    for position, rule_data in enumerate(policy['rules']):
+        if not isinstance(rule_data, dict):
+            raise ValueError('Rule %d is not an object' % position)
+
+        name = rule_data.get('name', str(position))
+
+        unknown = [key for key in rule_data if key not in POLICY_KEYS]
+        if unknown:
+            raise ValueError("Unknown keys in rule '%s': %s" % (name, ', '.join(unknown)))
+
+        if rule_data.get('type', None) not in request_types:
+            raise ValueError("Rule '%s' needs a type among: %s" % (name, ', '.join(sorted(request_types))))
+
+        receivers = rule_data.get('receiver', None)
+        if isinstance(receivers, str):
+            receivers = [receivers, ]
+        if not receivers or not all(isinstance(pattern, str) for pattern in receivers):
+            raise ValueError("Rule '%s' needs a receiver pattern or a list of them" % name)
+
+        if not isinstance(rule_data.get('ca', None), str):
+            raise ValueError("Rule '%s' needs the ca signing its requests" % name)
+
+        rules.append(PolicyRule(
+                name,
+                rule_data['type'],
+                receivers,
+                rule_data['ca'],
+                root_allowed=bool(rule_data.get('rootRequested', False)),
+                ))
+
+    return rules
+
+
+def unlock_authorities(authorities, idle_timeout=UNATTENDED_IDLE_TIMEOUT):
+    """
+    Ask now the passphrases of the authority keys, so
+    the auto signer never waits for them
+    """
+    for authority in authorities:
+        if authority.signer == 'native' and native_available():
+            authority.native_unlock()
+        elif start_agent().use(authority.path) is None:
+            authority.agent_unlock(start_agent(), idle_timeout)
+
+
+def unattended(authority):
+    """
+    Whether the authority can sign without asking for a passphrase
+    """
+    if authority.signer == 'native' and native_available():
+        return private_key_loaded(authority.path)
+
+    agent = current_agent()
+    return agent is not None and agent.use(authority.path) is not None
+
+
+def open_log(path=AUTOSIGN_LOG_PATH):
+    """
+    Send the decisions to path, and not to the shell
+    """
+    path = os.path.abspath(path)
+
+    if not any(getattr(handler, 'baseFilename', None) == path for handler in logger.handlers):
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handler.addFilter(lambda record: record.name == logger.name or _from_auto_signer(record))
+        logger.addHandler(handler)
+
+        # the warnings of the signing code go to the log when they
+        # come from the auto signer, and to the shell otherwise
+        console = logging.StreamHandler()
+        console.addFilter(lambda record: not _from_auto_signer(record))
+
+        signing_logger = logging.getLogger('signing')
+        signing_logger.addHandler(handler)
+        signing_logger.addHandler(console)
+        signing_logger.propagate = False
+
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def _from_auto_signer(record):
+    return record.threadName.startswith(AUTO_SIGNER_THREAD)
+
+
+def describe(request):
+    if request.key_type is None:
+        return request.req_id
+    return '%s (%s %s, key %s)' % (request.req_id, request.key_type, request.receiver, request.key_fingerprint)
+
+
+class AutoSigner(threading.Thread):
+    """
+    Background thread applying the policy to the queued requests,
+    woken by inotify or every RESCAN_INTERVAL seconds
+    """
+
+    def __init__(self, rules, policy_path=AUTOSIGN_POLICY_PATH, interval=RESCAN_INTERVAL):
+        super(AutoSigner, self).__init__(name=AUTO_SIGNER_THREAD, daemon=True)
+
+        self.rules = rules
+        self.policy_path = policy_path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+        self.policy_mtime = self.read_policy_mtime()
+        # why the auto signer stopped by itself
+        self.stop_reason = None
+
+        # ids of the requests already decided, signed
+        # ones included until their file is gone
+        self.decided = set()
+
+        self.signed = 0
+        self.failed = 0
+        self.left = 0
+
+    def read_policy_mtime(self):
+        try:
+            return os.stat(self.policy_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def policy_changed(self):
+        """
+        Whether the policy file changed since the operator confirmed
+        its rules, the new ones are not applied without confirmation
+        """
+        return self.read_policy_mtime() != self.policy_mtime
+
+    def run(self):
+        # ca-server links every new request in the index, one watch
+        # is enough whatever the shard levels, and stays open across
+        # the scans so no request is missed in between
+        try:
+            os.makedirs(REQUEST_INDEX_PATH, exist_ok=True)
+        except OSError:
+            # open_watch fails and the requests are scanned every interval
+            pass
+        watcher = open_watch([REQUEST_INDEX_PATH, ])
+
+        try:
+            self.serve(watcher)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def serve(self, watcher):
+        with database_connection():
+            # lookups of its own, the ones of the shell are not shared
+            ca_manager = CAManager(MANAGER_PATH)
+            logger.info('Auto signer started, %d rules', len(self.rules))
+
+            while not self.stopped.is_set():
+                try:
+                    self.process(ca_manager)
+                except Exception:
+                    logger.exception('Could not process the queued requests')
+
+                if self.stopped.is_set():
+                    break
+
+                if watcher is not None:
+                    watcher.read(self.interval)
+                else:
+                    self.stopped.wait(self.interval)
+
+            logger.info('Auto signer stopped, %d signed, %d failed, %d left to the operator', self.signed, self.failed, self.left)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def leave(self, request, reason, *args):
+        logger.info('Left %s to the operator: ' + reason, describe(request), *args)
+        self.left += 1
+
+    def process(self, ca_manager):
+        """
+        Sign the queued requests matching a rule, a batch per CA
+        """
+        if self.policy_changed():
+            self.stop_reason = 'the policy %s changed' % self.policy_path
+            logger.warning('Stopping, %s: start the auto signer again to confirm the new rules', self.stop_reason)
+            self.stopped.set()
+            return
+
+        requests = list(ca_manager.request)
+        self.decided &= set(request.req_id for request in requests)
+
+        # ca_id: (authority, [(request, rule), ...])
+        batches = {}
+
+        for request in requests:
+            if request.req_id in self.decided:
+                continue
+            self.decided.add(request.req_id)
+
+            if request.key_type is None:
+                self.leave(request, 'not a valid request')
+                continue
+
+            if not valid_receiver(request.key_type, request.receiver):
+                self.leave(request, 'the receiver is not a single name')
+                continue
+
+            rule = next((rule for rule in self.rules if rule.matches(request)), None)
+            if rule is None:
+                self.leave(request, 'no rule matches')
+                continue
+
+            authority = ca_manager.ca[rule.ca_id]
+            if authority is None:
+                self.leave(request, "rule '%s' names the unknown CA %s", rule.name, rule.ca_id)
+                continue
+
+            if type(request) not in authority.request_allowed:
+                self.leave(request, "rule '%s' names %s, that does not sign %s requests", rule.name, rule.ca_id, request.key_type)
+                continue
+
+            if not unattended(authority):
+                self.leave(request, 'the key of %s is locked', rule.ca_id)
+                continue
+
+            batches.setdefault(authority.ca_id, (authority, []))[1].append((request, rule))
+
+        for authority, matched in batches.values():
+            results = authority.sign_many([request for request, rule in matched])
+
+            for (request, result), (_, rule) in zip(results, matched):
+                if isinstance(result, Exception):
+                    logger.error('Could not sign %s with %s, rule %s: %s', describe(request), authority.ca_id, rule.name, result)
+                    self.failed += 1
+                    continue
+
+                try:
+                    del ca_manager.request[request.req_id]
+                except OSError:
+                    # dropped by the operator meanwhile, signed anyway
+                    pass
+                publish_result(result, request.req_id)
+
+                logger.info("Signed %s with %s, rule '%s'", describe(request), authority.ca_id, rule.name)
+                self.signed += 1
+
+
+_auto_signer = None
+
+
+def current_auto_signer():
+    return _auto_signer
+
+
+def start_auto_signer(rules, policy_path=AUTOSIGN_POLICY_PATH):
+    """
+    Return the auto signer of this session, starting it if needed
+    """
+    global _auto_signer
+
+    # an auto signer stopped by a policy change is replaced
+    if _auto_signer is None or not _auto_signer.is_alive():
+        open_log()
+
+        auto_signer = AutoSigner(rules, policy_path)
+        auto_signer.start()
+        _auto_signer = auto_signer
+    return _auto_signer
+
+
+def stop_auto_signer():
+    global _auto_signer
+
+    auto_signer = _auto_signer
+    if auto_signer is not None:
+        auto_signer.stop()
+        _auto_signer = None
+    return auto_signer
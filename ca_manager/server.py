@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+import codecs
+from fqdn import FQDN
+import hashlib
+import json
+import logging
+import os
+import os.path
+import signal
+import socketserver
+import struct
+import sys
+import time
+import uuid
+
+from .files import file_lock, read_cached, shard_path, symlink_atomic, write_atomic
+from .models.request import MAX_PRIORITY, MIN_PRIORITY, REQUEST_INDEX_LOCK_PATH, REQUEST_INDEX_PATH, REUSABLE_KEY_TYPES, REUSE_INDEX_PATH, key_fingerprint, request_hash, reuse_hash, valid_receiver
+from .notify import wait_for_file, wait_for_files
+from .paths import *
+
+__doc__ = """
+JSON protocol used by the ca-server shell, served either for a
+single request or by a long-running daemon on a Unix socket
+"""
+
+logfile = os.path.join(REQUEST_USER_HOME, 'request_server.log')
+
+logger = logging.getLogger('request_server')
+
+# maximum size in bytes of a single request document
+REQUEST_SIZE_LIMIT = 1024 * 1024
+
+# seconds an existing certificate must still be valid to be sent
+# again to a reuseExisting sign request
+REUSE_MIN_VALIDITY = 30 * 24 * 60 * 60
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+def setup_logging():
+    logging.basicConfig(
+            filename=logfile,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            level=logging.INFO,
+            )
+
+
+def response_good(response):
+    logger.info('JSON accepted, send ok')
+    response['failed'] = False
+    response['status'] = 'ok'
+    return response
+
+
+def response_pending(response):
+    logger.info('Result not ready, send pending')
+    response['failed'] = False
+    response['status'] = 'pending'
+    return response
+
+
+def response_not_modified(response):
+    logger.info('Client is up to date, send not_modified')
+    response['failed'] = False
+    response['status'] = 'not_modified'
+    return response
+
+
+def response_bad(reason):
+    logger.info('JSON rejected, send error; error %s', reason)
+    return {
+        'failed': True,
+        'status': 'error',
+        'reason': reason,
+        'msg': reason,
+    }
+
+
+def request_receiver(request):
+    return request.get('hostName', None) or request.get('userName', None) or request.get('caName', None)
+
+
+def submit_request(request):
+    """
+    Store a sign request in REQUESTS_PATH, return the response
+
+    A request equal to one still pending is not stored again, the
+    pending one counts one more submission, takes the higher of the
+    two priorities and its id is returned
+    """
+    if request['keyType'].endswith('_host'):
+        if not FQDN(request['hostName']).is_valid:
+            return response_bad('bad FQDN: <%s>' % (request['hostName'],))
+
+    if not valid_receiver(request['keyType'], request_receiver(request)):
+        return response_bad('bad receiver: <%s>' % (request_receiver(request),))
+
+    priority = request.get('priority', 0)
+    if type(priority) != int or not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        return response_bad('priority must be an integer from %d to %d' % (MIN_PRIORITY, MAX_PRIORITY))
+
+    digest = request_hash(
+            request['keyType'],
+            request_receiver(request),
+            request['keyData'],
+            request.get('rootRequested', False),
+            )
+    index_path = os.path.join(REQUEST_INDEX_PATH, digest)
+
+    with file_lock(REQUEST_INDEX_LOCK_PATH):
+        try:
+            request_id = os.readlink(index_path)
+            with open(shard_path(REQUESTS_PATH, request_id), 'r') as stream:
+                pending = json.load(stream)
+        except (OSError, ValueError):
+            # no such request, or already signed
+            pending = None
+
+        # the CA manager deletes the signed requests holding the lock
+        # too, a file still there is not signed and can be rewritten
+        if pending is not None and os.path.exists(shard_path(REQUESTS_PATH, request_id)):
+            logger.info('Request already pending with id %s', (request_id,))
+            pending['submissions'] = pending.get('submissions', 1) + 1
+            pending['priority'] = max(pending.get('priority', 0), priority)
+            write_atomic(shard_path(REQUESTS_PATH, request_id), json.dumps(pending).encode('utf-8'))
+
+            return response_good({'requestID': request_id, 'duplicate': True})
+
+        request_id = str(uuid.uuid4())
+        logger.info('Request id %s', (request_id,))
+
+        request = dict(request, submissions=1, priority=priority, submittedAt=time.time())
+
+        logger.info('Writing request to target directory')
+        write_atomic(shard_path(REQUESTS_PATH, request_id), json.dumps(request).encode('utf-8'))
+        symlink_atomic(request_id, index_path)
+
+    return response_good({'requestID': request_id})
+
+
+def find_existing(request, min_validity=REUSE_MIN_VALIDITY):
+    """
+    Return the answer with a valid certificate already issued for
+    the same receiver, type and key, None when there isn't one
+
+    The certificates are looked up in REUSE_INDEX_PATH, where the
+    CA manager publishes them and withdraws the revoked ones
+    """
+    if request['keyType'] not in REUSABLE_KEY_TYPES:
+        return None
+
+    digest = reuse_hash(request['keyType'], request_receiver(request), key_fingerprint(request['keyData']))
+
+    try:
+        cert_id, not_after = os.readlink(os.path.join(REUSE_INDEX_PATH, digest)).split(':')
+        if float(not_after) < time.time() + float(min_validity):
+            return None
+
+        response = read_result(cert_id)
+    except (OSError, ValueError):
+        return None
+
+    logger.info('Sending again the certificate %s', cert_id)
+    response['reused'] = True
+    return response
+
+
+def sign_or_reuse(request, metarequest):
+    """
+    Answer a sign request, with an existing certificate
+    if the client asked to reuse one
+    """
+    if metarequest.get('reuseExisting', False):
+        response = find_existing(request, metarequest.get('minValidity', REUSE_MIN_VALIDITY))
+        if response is not None:
+            return response
+
+    return submit_request(request)
+
+
+def read_result(request_id):
+    with open(shard_path(RESULTS_PATH, request_id), 'r') as stream:
+        result_data = stream.read()
+
+    return response_good({'requestID': request_id, 'result': result_data})
+
+
+def parse_timeout(metarequest):
+    """
+    Return the client timeout in seconds, None to wait
+    until the certificate is signed
+    """
+    timeout = metarequest.get('timeout', None)
+    if timeout is not None:
+        timeout = float(timeout)
+    return timeout
+
+
+def handle_sign_request(metarequest):
+    logger.info('Got a sign request')
+    yield sign_or_reuse(metarequest['request'], metarequest)
+
+
+def handle_sign_request_batch(metarequest):
+    requests = metarequest['requests']
+    logger.info('Got a batch of %d sign requests', len(requests))
+
+    results = []
+    for request in requests:
+        try:
+            results.append(sign_or_reuse(request, metarequest))
+        except (KeyError, TypeError, AttributeError, ValueError):
+            results.append(response_bad('bad_request'))
+
+    yield response_good({'results': results})
+
+
+def valid_request_id(request_id):
+    """
+    Whether request_id is an id given by submit_request, the
+    client ids are checked before building any path with them
+    """
+    try:
+        return str(uuid.UUID(request_id)) == request_id
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def handle_get_certificate(metarequest):
+    logger.info('Got a GET request')
+    request_id = metarequest['requestID']
+
+    logger.info('Request id: %s', (request_id,))
+    if not valid_request_id(request_id):
+        yield response_bad('bad_request_id')
+        return
+
+    result_path = shard_path(RESULTS_PATH, request_id)
+
+    try:
+        timeout = parse_timeout(metarequest)
+    except (TypeError, ValueError):
+        yield response_bad('bad_timeout')
+        return
+
+    if not wait_for_file(result_path, timeout):
+        yield response_pending({'requestID': request_id})
+        return
+
+    yield read_result(request_id)
+
+
+def handle_get_certificate_batch(metarequest):
+    """
+    Stream back each certificate as soon as it is signed
+    """
+    request_ids = [str(request_id) for request_id in metarequest['requestIDs']]
+    logger.info('Got a batch GET request for %d ids', len(request_ids))
+
+    if not all(valid_request_id(request_id) for request_id in request_ids):
+        yield response_bad('bad_request_id')
+        return
+
+    try:
+        timeout = parse_timeout(metarequest)
+    except (TypeError, ValueError):
+        yield response_bad('bad_timeout')
+        return
+
+    paths = dict((shard_path(RESULTS_PATH, request_id), request_id) for request_id in request_ids)
+    pending = set(request_ids)
+
+    for result_path in wait_for_files(paths, timeout):
+        request_id = paths[result_path]
+        pending.discard(request_id)
+        yield read_result(request_id)
+
+    for request_id in request_ids:
+        if request_id in pending:
+            yield response_pending({'requestID': request_id})
+
+
+def read_revocation(ca_id, name):
+    """
+    Return the content of a revocation list published in
+    REVOCATION_PATH, None if the CA has none
+    """
+    if not ca_id or ca_id.startswith('.') or os.path.basename(ca_id) != ca_id:
+        raise ValueError('bad_ca_id')
+
+    try:
+        return read_cached(os.path.join(REVOCATION_PATH, name % ca_id))
+    except FileNotFoundError:
+        return None
+
+
+def handle_get_krl(metarequest):
+    """
+    Send the key revocation list of a SSH authority, unless the
+    client already has its current version
+    """
+    ca_id = str(metarequest['caID'])
+    logger.info('Got a KRL request for %s', ca_id)
+
+    try:
+        krl = read_revocation(ca_id, '%s.krl')
+    except ValueError as e:
+        yield response_bad(str(e))
+        return
+
+    if krl is None:
+        yield response_bad('no_krl')
+        return
+
+    # the KRL version follows the magic and the format version
+    version, = struct.unpack('>Q', krl[12:20])
+
+    if metarequest.get('version', None) == version:
+        yield response_not_modified({'caID': ca_id, 'version': version})
+        return
+
+    yield response_good({
+        'caID': ca_id,
+        'version': version,
+        'krl': base64.b64encode(krl).decode('ascii'),
+        })
+
+
+def handle_get_crl(metarequest):
+    """
+    Send the full or delta CRL of a SSL authority, in PEM or base64
+    encoded DER, unless the client already has the same one
+    """
+    ca_id = str(metarequest['caID'])
+    delta = bool(metarequest.get('delta', False))
+    crl_format = metarequest.get('format', 'pem')
+    logger.info('Got a %s CRL request for %s', 'delta' if delta else 'full', ca_id)
+
+    if crl_format not in ('pem', 'der'):
+        yield response_bad('bad_format')
+        return
+
+    name = '%s-delta.crl' if delta else '%s.crl'
+    if crl_format == 'pem':
+        name += '.pem'
+
+    try:
+        crl = read_revocation(ca_id, name)
+    except ValueError as e:
+        yield response_bad(str(e))
+        return
+
+    if crl is None:
+        yield response_bad('no_crl')
+        return
+
+    crl_hash = hashlib.sha256(crl).hexdigest()
+
+    if metarequest.get('hash', None) == crl_hash:
+        yield response_not_modified({'caID': ca_id, 'hash': crl_hash})
+        return
+
+    if crl_format == 'pem':
+        crl = crl.decode('ascii')
+    else:
+        crl = base64.b64encode(crl).decode('ascii')
+
+    yield response_good({'caID': ca_id, 'hash': crl_hash, 'crl': crl})
+
+
+handlers = {
+    'sign_request': handle_sign_request,
+    'sign_request_batch': handle_sign_request_batch,
+    'get_certificate': handle_get_certificate,
+    'get_certificate_batch': handle_get_certificate_batch,
+    'get_krl': handle_get_krl,
+    'get_crl': handle_get_crl,
+}
+
+
+def read_request(stream, limit=REQUEST_SIZE_LIMIT):
+    """
+    Read a JSON document from a binary stream, stop as soon
+    as it is complete without waiting for the end of input
+
+    The data is parsed only when it ends with a closing brace,
+    as a complete request does, or at the end of input
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    parts = []
+    size = 0
+
+    while True:
+        chunk = stream.read1(4096) if hasattr(stream, 'read1') else stream.read(4096)
+        size += len(chunk)
+        if size > limit:
+            raise RequestTooLarge(size)
+
+        parts.append(text_decoder.decode(chunk, final=not chunk))
+        if chunk and not parts[-1].rstrip().endswith('}'):
+            continue
+
+        request_data = ''.join(parts).strip()
+        parts = [request_data, ]
+
+        if not request_data:
+            if not chunk:
+                raise ValueError('empty request')
+            continue
+
+        try:
+            metarequest, end = decoder.raw_decode(request_data)
+            return metarequest
+        except ValueError:
+            if not chunk:
+                raise
+
+
+def handle_request(metarequest):
+    """
+    Answer a JSON request, yield one response dictionary or a
+    stream of them for the batch requests
+    """
+    logger.info('Got request data: <%s>', (metarequest,))
+
+    if not isinstance(metarequest, dict) or 'type' not in metarequest:
+        logger.info('"type" key not found in request')
+        yield response_bad('bad_json')
+        return
+
+    handler = handlers.get(metarequest['type'], None)
+    if handler is None:
+        logger.info('Request type not supported: %s', metarequest['type'])
+        yield response_bad('unknown_type')
+        return
+
+    try:
+        for response in handler(metarequest):
+            yield response
+    except (KeyError, TypeError, AttributeError, ValueError):
+        logger.exception('Malformed %s request', metarequest['type'])
+        yield response_bad('bad_request')
+
+
+def handle_stream(in_stream, out_stream, limit=REQUEST_SIZE_LIMIT):
+    """
+    Read a request from in_stream and write every
+    response to out_stream as a line of JSON
+    """
+    try:
+        responses = handle_request(read_request(in_stream, limit))
+    except RequestTooLarge:
+        logger.info('Request larger than %d bytes', limit)
+        responses = [response_bad('request_too_large')]
+    except ValueError:
+        logger.info('Request is not valid JSON')
+        responses = [response_bad('bad_json')]
+
+    for response in responses:
+        out_stream.write(json.dumps(response).encode('utf-8') + b'\n')
+        out_stream.flush()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serve one request per connection, responses are written
+    as lines of JSON as soon as they are available
+    """
+
+    def handle(self):
+        logger.info('Connection accepted')
+        handle_stream(self.rfile, self.wfile, self.server.request_size_limit)
+        logger.info('Connection closed')
+
+
+class RequestServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_size_limit = REQUEST_SIZE_LIMIT
+
+
+def serve(socket_path=SERVER_SOCKET_PATH, request_size_limit=REQUEST_SIZE_LIMIT):
+    """
+    Run the request server daemon on a Unix socket
+    """
+    setup_logging()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = RequestServer(socket_path, RequestHandler)
+    server.request_size_limit = request_size_limit
+    os.chmod(socket_path, 0o660)
+
+    # let the socket be removed on a plain kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    logger.info('Daemon listening on %s', socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        logger.info('Daemon stopped')
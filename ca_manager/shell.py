@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
 import cmd
+from fnmatch import fnmatch
+import shlex
+import subprocess
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from ca_manager.models.ssh import SSHAuthority
 from ca_manager.models.ssl import SSLAuthority
+from ca_manager.lookup import request_types
+from ca_manager.models.certificate import Certificate, REVOCATION_REASONS
+from ca_manager.models.request import parse_queue_cursor
 
-from ca_manager.manager import sign_request
+from ca_manager.agent import DEFAULT_IDLE_TIMEOUT, current_agent, start_agent, stop_agent
+from ca_manager.crypto import forget_private_keys, NativeSigningError
+from ca_manager.export import EXPORT_FORMATS, export_certificates
+from ca_manager.manager import backfill_expiry, migrate_layout, publish_reusable, revoke_certificates, sign_request, sign_requests
+from ca_manager.paths import AUTOSIGN_LOG_PATH, AUTOSIGN_POLICY_PATH, SHARD_LEVELS
+from ca_manager.policy import current_auto_signer, load_policy, start_auto_signer, stop_auto_signer, unlock_authorities
 
 __doc__ = """
 Class to make a shell and interact with the user
@@ -26,18 +38,128 @@ class CAManagerShell(cmd.Cmd):
         self.ca_manager = ca_manager
 
     def do_ls_cas(self, l):
-        'List the available certification authorities: LS_CA'
-        for i, authority in enumerate(self.ca_manager.ca):
+        'List the available certification authorities: LS_CAS [--type ssh|ssl] [--page-size N] [--after ca_id]'
+        args = parse_arguments(ls_cas_parser, l)
+        if args is None:
+            return
+
+        authority_type = {'ssh': SSHAuthority, 'ssl': SSLAuthority, None: None}[args.type]
+        authorities = self.ca_manager.ca.query(authority_type, args.after, args.page_size)
+
+        for authority in authorities:
             print(authority)
 
+        print_next_page('ls_cas', l, authorities, args.page_size, lambda ca: ca.ca_id)
+
     def do_ls_certificates(self, l):
-        'List the issued certificates: LS_CERTIFICATES'
-        for i, cert in enumerate(self.ca_manager.certificate):
+        'List the issued certificates: LS_CERTIFICATES [--ca ca_id] [--receiver prefix] [--revoked | --valid] [--issued-after date] [--issued-before date] [--page-size N] [--after cursor]'
+        args = parse_arguments(ls_certificates_parser, l)
+        if args is None:
+            return
+
+        authority = None
+        if args.ca is not None:
+            authority = self.ca_manager.ca[args.ca]
+
+            if authority is None:
+                print("No CA found for id: '%s'" % args.ca)
+                return
+
+        certificates = self.ca_manager.certificate.query(
+                authority=authority,
+                receiver_prefix=args.receiver,
+                revoked=args.revoked,
+                issued_after=args.issued_after,
+                issued_before=args.issued_before,
+                after=args.after,
+                limit=args.page_size,
+                )
+
+        for cert in certificates:
             print(cert)
 
+        print_next_page('ls_certificates', l, certificates, args.page_size, lambda cert: cert.id)
+
+    def do_export_certificates(self, l):
+        'Dump the issued certificates: EXPORT_CERTIFICATES [--format jsonl|csv] [--output path] [--with-body] [--ca ca_id] [--receiver prefix] [--revoked | --valid]'
+        args = parse_arguments(export_certificates_parser, l)
+        if args is None:
+            return
+
+        authority = None
+        if args.ca is not None:
+            authority = self.ca_manager.ca[args.ca]
+
+            if authority is None:
+                print("No CA found for id: '%s'" % args.ca)
+                return
+
+        filters = dict(authority=authority, receiver_prefix=args.receiver, revoked=args.revoked)
+
+        if args.output is None:
+            export_certificates(sys.stdout, args.format, args.with_body, **filters)
+            return
+
+        with open(args.output, 'w', newline='') as stream:
+            count = export_certificates(stream, args.format, args.with_body, **filters)
+        print("Exported %d certificates to %s" % (count, args.output))
+
+    def do_ls_expiring(self, l):
+        'List the certificates expiring in the next days: LS_EXPIRING days [ca_id]'
+        argv = l.split()
+        argc = len(argv)
+
+        # argument number is too low
+        if argc < 1 or not argv[0].isdigit():
+            print("Usage: LS_EXPIRING days [ca_id]")
+            return
+
+        authority = None
+        if argc > 1:
+            authority = self.ca_manager.ca[argv[1]]
+
+            if authority is None:
+                print("No CA found for id: '%s'" % argv[1])
+                return
+
+        for cert in self.ca_manager.certificate.expiring(timedelta(days=int(argv[0])), authority):
+            print("%s  %s" % (cert.not_after, cert))
+
+    def do_backfill_expiry(self, l):
+        'Read the validity period and the SSL serial of the certificates issued by older versions, and publish them for reuse: BACKFILL_EXPIRY'
+        updated, failed = backfill_expiry()
+        print("Updated %d certificates" % updated)
+
+        for cert in failed:
+            print("Could not read '%s' from %s" % (cert.cert_id, cert.path))
+
+        published = publish_reusable()
+        print("Published %d certificates for reuse" % published)
+
     def do_ls_requests(self, l):
-        'List the available certification requests: LS_REQUESTS'
-        print_available_requests(self.ca_manager)
+        'List the pending certification requests, most urgent first: LS_REQUESTS [--type key_type] [--receiver prefix] [--page-size N] [--after cursor]'
+        args = parse_arguments(ls_requests_parser, l)
+        if args is None:
+            return
+
+        requests = self.ca_manager.request.query(args.type, args.receiver, args.after, args.page_size)
+
+        for request in requests:
+            print(request)
+
+        print_next_page('ls_requests', l, requests, args.page_size, lambda request: request.queue_cursor)
+
+    def do_queue_status(self, l):
+        'Show the number of pending requests, by type, and the oldest one: QUEUE_STATUS'
+        depth, oldest, counts = self.ca_manager.request.status()
+
+        print("Pending requests: %d" % depth)
+        for key_type, count in sorted(counts.items(), key=lambda item: str(item[0])):
+            print("  %s: %d" % (key_type or 'invalid', count))
+
+        if oldest is not None:
+            waiting = datetime.now() - oldest.submitted_at
+            print("Oldest request: %s, waiting for %s" % (oldest.req_id, timedelta(seconds=int(waiting.total_seconds()))))
 
     def do_describe_ca(self, l):
         'Show certification authority information: DESCRIBE_CA ca_id'
@@ -58,6 +180,7 @@ class CAManagerShell(cmd.Cmd):
             CA type: %s
             CA name: %s
             Serial: %s
+            Signer: %s
             """
 
             ca_info = (
@@ -65,6 +188,7 @@ class CAManagerShell(cmd.Cmd):
                     ca.__class__.__name__,
                     ca.name,
                     ca.serial,
+                    ca.signer,
                     )
 
             print(ca_description % ca_info)
@@ -92,7 +216,9 @@ class CAManagerShell(cmd.Cmd):
             Receiver: %s
             Certificate Serial: %s
             Validity Interval: %s
+            Valid: from %s to %s
             Revoked: %s
+            Revocation: %s %s
             """
 
             cert_info = (
@@ -100,9 +226,13 @@ class CAManagerShell(cmd.Cmd):
                     cert.authority,
                     cert.date_issued,
                     cert.receiver,
-                    cert.serial_number,
+                    Certificate.real_serial(cert.serial_number, cert.issued_serial),
                     cert.validity_interval,
+                    cert.not_before,
+                    cert.not_after,
                     cert.revoked,
+                    cert.revocation_date,
+                    cert.revocation_reason,
                     )
 
             print(cert_description % cert_info)
@@ -128,6 +258,7 @@ class CAManagerShell(cmd.Cmd):
             --------------------------------------------------
             Request type: %s
             %s
+            Priority: %d, submitted on %s
             Key %s
             """
 
@@ -135,6 +266,8 @@ class CAManagerShell(cmd.Cmd):
                     request.req_id,
                     request.__class__.__name__,
                     request.fields,
+                    request.priority,
+                    request.submitted_at,
                     request.key_data,
                     )
 
@@ -167,10 +300,11 @@ class CAManagerShell(cmd.Cmd):
 
         ca_id = argv[0]
         name = argv[1]
+        # a KRL can't revoke the serial 0
         new_auth = SSHAuthority(
                 ca_id=ca_id,
                 name=name,
-                serial=0,
+                serial=1,
                 active=True,
                 creation_date=datetime.now(),
                 )
@@ -190,10 +324,11 @@ class CAManagerShell(cmd.Cmd):
 
         ca_id = argv[0]
         name = argv[1]
+        # X.509 serial numbers must be positive
         new_auth = SSLAuthority(
                 ca_id=ca_id,
                 name=name,
-                serial=0,
+                serial=1,
                 active=True,
                 creation_date=datetime.now(),
                 )
@@ -201,6 +336,76 @@ class CAManagerShell(cmd.Cmd):
         new_auth.generate()
         new_auth.save()
 
+    def do_set_signer(self, l):
+        'Choose the engine used by a CA to sign certificates: SET_SIGNER ca_id signer'
+        argv = l.split()
+        argc = len(argv)
+
+        # argument number is too low
+        if argc < 2:
+            print("Usage: SET_SIGNER ca_id signer")
+            return
+
+        ca = self.ca_manager.ca[argv[0]]
+
+        if ca is None:
+            print("No CA found for id: '%s'" % argv[0])
+            return
+
+        if argv[1] not in ca.signers:
+            print("Signer '%s' not supported, choose one of: %s" % (argv[1], ', '.join(ca.signers)))
+            return
+
+        ca.signer = argv[1]
+        ca.save()
+
+    def do_unlock(self, l):
+        'Unlock the key of a CA into the signing agent: UNLOCK ca_id [idle_timeout_seconds]'
+        argv = l.split()
+        argc = len(argv)
+
+        # argument number is too low
+        if argc < 1:
+            print("Usage: UNLOCK ca_id [idle_timeout_seconds]")
+            return
+
+        ca = self.ca_manager.ca[argv[0]]
+
+        if ca is None:
+            print("No CA found for id: '%s'" % argv[0])
+            return
+
+        idle_timeout = int(argv[1]) if argc > 1 else DEFAULT_IDLE_TIMEOUT
+
+        try:
+            ca.agent_unlock(start_agent(), idle_timeout)
+        except (ValueError, subprocess.CalledProcessError) as e:
+            print("Could not unlock the key of CA '%s': %s" % (ca.ca_id, e))
+
+    def do_lock(self, l):
+        'Remove the key of a CA from the signing agent: LOCK ca_id'
+        argv = l.split()
+        argc = len(argv)
+
+        # argument number is too low
+        if argc < 1:
+            print("Usage: LOCK ca_id")
+            return
+
+        ca = self.ca_manager.ca[argv[0]]
+        agent = current_agent()
+
+        if ca is None or agent is None or not agent.lock_key(ca.path):
+            print("No unlocked key for CA: '%s'" % argv[0])
+
+    def do_ls_unlocked(self, l):
+        'List the CA keys held by the signing agent: LS_UNLOCKED'
+        agent = current_agent()
+
+        if agent is not None:
+            for key in agent:
+                print(key)
+
     def do_sign_request(self, l):
         'Sign a request using a CA: SIGN_REQUEST ca_id request_id'
         argv = l.split()
@@ -223,19 +428,187 @@ class CAManagerShell(cmd.Cmd):
 
             sign_request(self.ca_manager, request_id, authority_id)
 
-    def do_revoke_certificates(self, l):
-        'Revoke the issued certificates: REVOKE_CERTIFICATE certificate_id ...'
+    def do_sign_requests(self, l):
+        'Sign all the requests matching a receiver pattern using a CA: SIGN_REQUESTS ca_id [receiver_pattern]'
         argv = l.split()
         argc = len(argv)
 
         # argument number is too low
         if argc < 1:
-            print("Usage: REVOKE_CERTIFICATE certificate_id ...")
+            print("Usage: SIGN_REQUESTS ca_id [receiver_pattern]")
+            return
 
-        for item in argv:
-            cert = self.ca_manager.certificate[item]
-            cert.revoked = True
-            cert.save()
+        ca = self.ca_manager.ca[argv[0]]
+
+        if ca is None:
+            print("No CA found for id: '%s'" % argv[0])
+            return
+
+        pattern = argv[1] if argc > 1 else '*'
+        requests = [
+                request for request in self.ca_manager.request
+                if request.__class__ in ca.request_allowed and fnmatch(request.receiver, pattern)
+                ]
+
+        if not requests:
+            print("No request matching '%s' for CA '%s'" % (pattern, ca.ca_id))
+            return
+
+        print("You are about to sign the following requests:")
+        for request in requests:
+            print("  %s" % request)
+        print("with the following CA:\n  %s" % ca)
+
+        confirm = input('Proceed with %d requests? (type yes)> ' % len(requests))
+        if confirm != 'yes':
+            print("user abort")
+            return
+
+        results = sign_requests(self.ca_manager, requests, ca)
+        failed = len([result for request, result in results if isinstance(result, Exception)])
+        print("Signed %d requests, %d failed" % (len(results) - failed, failed))
+
+    def do_migrate_layout(self, l):
+        'Move requests, outputs and results to the layout set by SHARD_LEVELS: MIGRATE_LAYOUT'
+        print("Stop ca-server before moving the files to %d levels of sub directories" % SHARD_LEVELS)
+        confirm = input('Proceed? (type yes)> ')
+        if confirm != 'yes':
+            print("user abort")
+            return
+
+        moved = migrate_layout(SHARD_LEVELS)
+        print("Moved %d files" % moved)
+
+    def do_revoke_certificates(self, l):
+        'Revoke the issued certificates: REVOKE_CERTIFICATES [certificate_id ...] [--ca ca_id] [--receiver prefix] [--issued-after date] [--issued-before date] [--reason reason]'
+        args = parse_arguments(revoke_certificates_parser, l)
+        if args is None:
+            return
+
+        authority = None
+        if args.ca is not None:
+            authority = self.ca_manager.ca[args.ca]
+
+            if authority is None:
+                print("No CA found for id: '%s'" % args.ca)
+                return
+
+        filters = dict(
+                authority=authority,
+                receiver_prefix=args.receiver,
+                issued_after=args.issued_after,
+                issued_before=args.issued_before,
+                )
+
+        if not args.cert_ids and not any(value is not None for value in filters.values()):
+            print("Usage: REVOKE_CERTIFICATES [certificate_id ...] [--ca ca_id] [--receiver prefix] [--issued-after date] [--issued-before date] [--reason reason]")
+            return
+
+        print("You are about to revoke (%s) the certificates:" % args.reason)
+        if args.cert_ids:
+            print("  with id in: %s" % ', '.join(args.cert_ids))
+        for name, value in sorted(filters.items()):
+            if value is not None:
+                print("  with %s: %s" % (name.replace('_', ' '), value))
+
+        confirm = input('Proceed? (type yes)> ')
+        if confirm != 'yes':
+            print("user abort")
+            return
+
+        revoked, already_revoked, unknown = revoke_certificates(args.reason, args.cert_ids, **filters)
+
+        print("Revoked %d certificates, %d were already revoked" % (revoked, already_revoked))
+        if unknown:
+            print("No certificate found for id: %s" % ', '.join(unknown))
+
+        if revoked:
+            update_revocation(self.ca_manager.ca)
+
+    def do_update_revocation(self, l):
+        'Publish the certificates revoked since the last update: UPDATE_REVOCATION [ca_id]'
+        argv = l.split()
+        argc = len(argv)
+
+        authorities = self.ca_manager.ca
+        if argc > 0:
+            authority = self.ca_manager.ca[argv[0]]
+
+            if authority is None:
+                print("No CA found for id: '%s'" % argv[0])
+                return
+            authorities = [authority, ]
+
+        update_revocation(authorities)
+
+    def do_autosign(self, l):
+        'Sign the requests matching the rules of AUTOSIGN_POLICY_PATH in the background: AUTOSIGN start|stop|status'
+        argv = l.split()
+        argc = len(argv)
+
+        if argc < 1 or argv[0] not in ('start', 'stop', 'status'):
+            print("Usage: AUTOSIGN start|stop|status")
+            return
+
+        auto_signer = current_auto_signer()
+
+        if argv[0] == 'status':
+            if auto_signer is None:
+                print("Auto signer stopped")
+                return
+
+            if not auto_signer.is_alive():
+                print("Auto signer stopped, %s: review it and AUTOSIGN start again" % auto_signer.stop_reason)
+            else:
+                print("Auto signer running, decisions logged to %s" % AUTOSIGN_LOG_PATH)
+            for rule in auto_signer.rules:
+                print("  %s" % rule)
+            print("Signed %d requests, %d failed, %d left to the operator" % (auto_signer.signed, auto_signer.failed, auto_signer.left))
+
+        elif argv[0] == 'stop':
+            auto_signer = stop_auto_signer()
+            if auto_signer is None:
+                print("Auto signer not running")
+                return
+            print("Signed %d requests, %d failed, %d left to the operator" % (auto_signer.signed, auto_signer.failed, auto_signer.left))
+
+        else:
+            if auto_signer is not None and auto_signer.is_alive():
+                print("Auto signer already running")
+                return
+
+            try:
+                rules = load_policy()
+            except (OSError, ValueError) as e:
+                print("Could not read the policy %s: %s" % (AUTOSIGN_POLICY_PATH, e))
+                return
+
+            authorities = {}
+            for rule in rules:
+                authority = self.ca_manager.ca[rule.ca_id]
+
+                if authority is None:
+                    print("No CA found for id: '%s'" % rule.ca_id)
+                    return
+                authorities[authority.ca_id] = authority
+
+            print("You are about to sign without confirmation the requests matching:")
+            for rule in rules:
+                print("  %s" % rule)
+
+            confirm = input('Proceed? (type yes)> ')
+            if confirm != 'yes':
+                print("user abort")
+                return
+
+            try:
+                unlock_authorities(authorities.values())
+            except (ValueError, subprocess.CalledProcessError, NativeSigningError) as e:
+                print("Could not unlock the CA keys: %s" % e)
+                return
+
+            start_auto_signer(rules)
+            print("Auto signer started, decisions logged to %s" % AUTOSIGN_LOG_PATH)
 
     def common_complete_request(self, text, line, begidx, endidx, check_argc=2):
         argv = ("%send" % line).split()
@@ -265,6 +638,24 @@ class CAManagerShell(cmd.Cmd):
     def complete_describe_request(self, text, line, begidx, endidx):
         return self.common_complete_request(text, line, begidx, endidx)
 
+    def complete_set_signer(self, text, line, begidx, endidx):
+        return self.common_complete_ca(text, line, begidx, endidx)
+
+    def complete_sign_requests(self, text, line, begidx, endidx):
+        return self.common_complete_ca(text, line, begidx, endidx)
+
+    def complete_unlock(self, text, line, begidx, endidx):
+        return self.common_complete_ca(text, line, begidx, endidx)
+
+    def complete_ls_expiring(self, text, line, begidx, endidx):
+        return self.common_complete_ca(text, line, begidx, endidx, 3)
+
+    def complete_update_revocation(self, text, line, begidx, endidx):
+        return self.common_complete_ca(text, line, begidx, endidx)
+
+    def complete_lock(self, text, line, begidx, endidx):
+        return self.common_complete_ca(text, line, begidx, endidx)
+
     def complete_sign_request(self, text, line, begidx, endidx):
         results = ''
         argc = len(("%send" % line).split())
@@ -289,8 +680,116 @@ class CAManagerShell(cmd.Cmd):
 
     def do_quit(self, l):
         'Quit this shell'
+        stop_auto_signer()
+        forget_private_keys()
+        stop_agent()
         return True
 
+    def do_EOF(self, l):
+        'Quit this shell'
+        print()
+        return self.do_quit(l)
+
+
+def parse_date(value):
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date '%s', use YYYY-MM-DD" % value)
+
+
+def page_size(value):
+    if not value.isdigit() or int(value) == 0:
+        raise argparse.ArgumentTypeError("invalid page size '%s'" % value)
+    return int(value)
+
+
+def queue_cursor(value):
+    try:
+        parse_queue_cursor(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid cursor '%s'" % value)
+    return value
+
+
+ls_cas_parser = argparse.ArgumentParser(prog='ls_cas', add_help=False)
+ls_cas_parser.add_argument('--type', choices=['ssh', 'ssl'])
+ls_cas_parser.add_argument('--page-size', type=page_size)
+ls_cas_parser.add_argument('--after')
+
+ls_certificates_parser = argparse.ArgumentParser(prog='ls_certificates', add_help=False)
+ls_certificates_parser.add_argument('--ca')
+ls_certificates_parser.add_argument('--receiver')
+ls_certificates_parser.add_argument('--revoked', action='store_true', default=None)
+ls_certificates_parser.add_argument('--valid', action='store_false', dest='revoked')
+ls_certificates_parser.add_argument('--issued-after', type=parse_date)
+ls_certificates_parser.add_argument('--issued-before', type=parse_date)
+ls_certificates_parser.add_argument('--page-size', type=page_size)
+ls_certificates_parser.add_argument('--after', type=int)
+
+ls_requests_parser = argparse.ArgumentParser(prog='ls_requests', add_help=False)
+ls_requests_parser.add_argument('--type', choices=sorted(request_types))
+ls_requests_parser.add_argument('--receiver')
+ls_requests_parser.add_argument('--page-size', type=page_size)
+ls_requests_parser.add_argument('--after', type=queue_cursor)
+
+export_certificates_parser = argparse.ArgumentParser(prog='export_certificates', add_help=False)
+export_certificates_parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl')
+export_certificates_parser.add_argument('--output')
+export_certificates_parser.add_argument('--with-body', action='store_true')
+export_certificates_parser.add_argument('--ca')
+export_certificates_parser.add_argument('--receiver')
+export_certificates_parser.add_argument('--revoked', action='store_true', default=None)
+export_certificates_parser.add_argument('--valid', action='store_false', dest='revoked')
+
+revoke_certificates_parser = argparse.ArgumentParser(prog='revoke_certificates', add_help=False)
+revoke_certificates_parser.add_argument('cert_ids', nargs='*')
+revoke_certificates_parser.add_argument('--ca')
+revoke_certificates_parser.add_argument('--receiver')
+revoke_certificates_parser.add_argument('--issued-after', type=parse_date)
+revoke_certificates_parser.add_argument('--issued-before', type=parse_date)
+revoke_certificates_parser.add_argument('--reason', choices=REVOCATION_REASONS, default='unspecified')
+
+
+def parse_arguments(parser, line):
+    """
+    Parse the arguments of a command, None if they are not valid
+    """
+    try:
+        return parser.parse_args(shlex.split(line))
+    except ValueError as e:
+        print("Error: %s" % e)
+    except SystemExit:
+        # argparse already printed the error
+        pass
+    return None
+
+
+def print_next_page(command, line, items, size, cursor):
+    """
+    Tell how to get the next page of a listing, when it is full
+    """
+    if size is None or len(items) < size:
+        return
+
+    argv = shlex.split(line)
+    if '--after' in argv:
+        del argv[argv.index('--after'):argv.index('--after') + 2]
+    argv = [arg for arg in argv if not arg.startswith('--after=')]
+
+    print("Next page: %s" % ' '.join([command] + [shlex.quote(arg) for arg in argv] + ['--after', shlex.quote(str(cursor(items[-1])))]))
+
+
+def update_revocation(authorities):
+    for authority in authorities:
+        try:
+            if authority.update_revocation():
+                print("Updated the revocation lists of %s" % authority.ca_id)
+        except (OSError, ValueError, subprocess.CalledProcessError, NativeSigningError) as e:
+            print("Could not update the revocation lists of %s: %s" % (authority.ca_id, e))
+
 
 def print_available_authorities(ca_manager):
     for i, ca in enumerate(ca_manager.ca):
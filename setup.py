@@ -17,7 +17,14 @@ setup(
         'fqdn',
         'peewee<3',
     ],
+    extras_require={
+        'native': [
+            'bcrypt',
+            'cryptography>=40',
+        ],
+    },
     scripts=[
+        'bin/ca-ocsp',
         'bin/ca-server',
         'bin/ca-shell',
     ],
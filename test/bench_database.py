@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import argparse
+from datetime import datetime
+import os.path
+import tempfile
+import threading
+import time
+import uuid
+
+from ca_manager.models.certificate import Certificate
+from ca_manager.models.customModel import DATABASE_PROFILES, configure_database, custom_db, database_connection
+from ca_manager.models.ssh import SSHAuthority
+
+
+def issue(authority, count):
+    """
+    The database work of Authority.sign_many, without the signing
+    """
+    first_serial = authority.reserve_serials(count)
+
+    with custom_db.atomic():
+        for serial in range(first_serial, first_serial + count):
+            cert_id = str(uuid.uuid4())
+            Certificate.create(
+                    authority=authority,
+                    cert_id=cert_id,
+                    date_issued=datetime.now(),
+                    receiver='host%d.example.com' % serial,
+                    serial_number=serial,
+                    validity_interval='+52w',
+                    path=os.path.join('/nonexistent', cert_id),
+                    )
+
+
+def list_certificates(stop, counter):
+    with database_connection():
+        while not stop.is_set():
+            for cert in Certificate.select().limit(1000).tuples():
+                pass
+            counter[0] += 1
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as directory:
+        configure_database(profile, os.path.join(directory, 'ca_manager.db'))
+
+        SSHAuthority.sync_table()
+        Certificate.sync_table()
+
+        authority = SSHAuthority.create(
+                ca_id='bench',
+                name='benchmark',
+                serial=0,
+                active=True,
+                isRoot=True,
+                creation_date=datetime.now(),
+                )
+
+        stop = threading.Event()
+        listings = [0]
+        reader = threading.Thread(target=list_certificates, args=(stop, listings))
+        reader.start()
+
+        start = time.monotonic()
+        for i in range(args.certificates // args.batch):
+            issue(authority, args.batch)
+        elapsed = time.monotonic() - start
+
+        stop.set()
+        reader.join()
+        custom_db.close()
+
+    print('%-12s %8.0f certificates/s  %6d listings while signing' % (profile, args.certificates / elapsed, listings[0]))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Compare the issuance throughput of the database profiles')
+    parser.add_argument('--certificates', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=1)
+
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+
+    for profile in sorted(DATABASE_PROFILES):
+        run(profile, args)
@@ -6,15 +6,23 @@ import json
 
 def main(args):
     result_dict = {}
-    result_dict['type'] = 'get_certificate'
-    result_dict['requestID'] = args.request_id
+    if len(args.request_id) > 1:
+        result_dict['type'] = 'get_certificate_batch'
+        result_dict['requestIDs'] = args.request_id
+    else:
+        result_dict['type'] = 'get_certificate'
+        result_dict['requestID'] = args.request_id[0]
+
+    if args.timeout is not None:
+        result_dict['timeout'] = args.timeout
 
     print(json.dumps(result_dict))
 
 
 def get_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('request_id')
+    parser.add_argument('request_id', nargs='+')
+    parser.add_argument('--timeout', type=float, default=None)
 
     return parser
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from ca_manager.manager import revoke_certificates
+from ca_manager.models.certificate import Certificate
+from ca_manager.models.customModel import configure_database, custom_db
+from ca_manager.models.ssh import HostSSHRequest, SSHAuthority
+
+
+@unittest.skipIf(shutil.which('ssh-keygen') is None, 'ssh-keygen is not installed')
+class KRLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # keep the CA, its outputs and the database out of /var/lib
+        for target in ('ca_manager.models.authority.MANAGER_PATH',
+                       'ca_manager.models.authority.REVOCATION_PATH',
+                       'ca_manager.models.request.OUTPUT_PATH',
+                       'ca_manager.models.ssh.REVOCATION_PATH'):
+            patcher = mock.patch(target, self.directory)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        configure_database('default', os.path.join(self.directory, 'ca_manager.db'))
+        self.addCleanup(custom_db.close)
+        SSHAuthority.sync_table()
+        Certificate.sync_table()
+
+        # the older authorities started at serial 0
+        self.authority = SSHAuthority.create(
+                ca_id='krl-test',
+                name='krl test',
+                serial=0,
+                active=True,
+                isRoot=True,
+                creation_date=datetime.now(),
+                )
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', self.authority.path])
+
+    def sign_host(self, request_id):
+        key_path = os.path.join(self.directory, request_id)
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', key_path])
+
+        with open(key_path + '.pub') as stream:
+            request = HostSSHRequest(request_id, '%s.example.com' % request_id, stream.read())
+
+        return self.authority.sign(request)
+
+    def is_revoked(self, cert_path):
+        krl_path = self.authority.krl_path
+        return subprocess.call(['ssh-keygen', '-Q', '-f', krl_path, cert_path], stdout=subprocess.DEVNULL) != 0
+
+    def revoke(self, cert_path):
+        cert = Certificate.get(Certificate.path == cert_path)
+        self.assertEqual(revoke_certificates(cert_ids=[cert.cert_id, ])[0], 1)
+
+    def test_revoke_first_certificate(self):
+        first = self.sign_host('first')
+        second = self.sign_host('second')
+        self.assertEqual(Certificate.get(Certificate.path == first).serial_number, 0)
+
+        self.revoke(first)
+        self.assertTrue(self.authority.update_krl())
+        self.assertTrue(self.is_revoked(first))
+        self.assertFalse(self.is_revoked(second))
+
+        # the KRL can still be updated afterwards
+        self.revoke(second)
+        self.assertTrue(self.authority.update_krl())
+        self.assertTrue(self.is_revoked(first))
+        self.assertTrue(self.is_revoked(second))
+
+    def test_revoked_before_the_update(self):
+        first = self.sign_host('first')
+        second = self.sign_host('second')
+        self.revoke(first)
+        self.assertTrue(self.authority.update_krl())
+
+        # committed after the update by a long revocation that started before it
+        self.revoke(second)
+        Certificate.update(revocation_date=datetime(2000, 1, 1)).where(Certificate.path == second).execute()
+
+        self.assertTrue(self.authority.update_krl())
+        self.assertTrue(self.is_revoked(second))
+        self.assertFalse(self.authority.update_krl())
+
+
+if __name__ == '__main__':
+    unittest.main()
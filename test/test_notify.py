@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os.path
+import tempfile
+import threading
+import time
+import unittest
+
+from ca_manager import notify
+from ca_manager.files import link_atomic, shard_path
+
+
+class WaitForFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        # keep what open_watch returned
+        self.watchers = []
+        open_watch = notify.open_watch
+
+        def recording_open_watch(directories):
+            watcher = open_watch(directories)
+            self.watchers.append(watcher)
+            return watcher
+
+        notify.open_watch = recording_open_watch
+        self.addCleanup(setattr, notify, 'open_watch', open_watch)
+
+    @unittest.skipIf(notify.Inotify.libc() is None, 'inotify is not available')
+    def test_fresh_shard_is_watched(self):
+        result_path = shard_path(self.directory.name, 'request-id', levels=2)
+        self.assertFalse(os.path.exists(os.path.dirname(result_path)))
+
+        source = os.path.join(self.directory.name, 'certificate')
+        with open(source, 'w') as stream:
+            stream.write('certificate')
+
+        def publish():
+            time.sleep(0.2)
+            link_atomic(source, result_path)
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        self.addCleanup(publisher.join)
+
+        start = time.monotonic()
+        self.assertTrue(notify.wait_for_file(result_path, timeout=5))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(self.watchers), 1)
+        self.assertIsNotNone(self.watchers[0])
+        # the polling fallback would have slept for longer
+        self.assertLess(elapsed, 1)
+
+    def test_timeout(self):
+        result_path = shard_path(self.directory.name, 'request-id', levels=1)
+        self.assertFalse(notify.wait_for_file(result_path, timeout=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ca_manager.models.request import valid_receiver
+from ca_manager.models.ssh import UserSSHRequest
+from ca_manager.policy import AutoSigner, PolicyRule, load_policy
+from ca_manager.server import submit_request
+
+
+class ReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = PolicyRule('developers', 'ssh_user', ['dev-*', ], 'ssh-users')
+
+    def test_single_name(self):
+        self.assertTrue(self.rule.matches(UserSSHRequest('id', 'dev-alice', False, 'key')))
+
+    def test_list_of_names(self):
+        # ssh-keygen -n would read two principals, root among them
+        for user_name in ('dev-x,root', 'dev-x root', 'dev-x\troot', 'dev-*', 'dev-[ab]', 'dev-?'):
+            with self.subTest(user_name=user_name):
+                self.assertFalse(self.rule.matches(UserSSHRequest('id', user_name, False, 'key')))
+
+    def test_root_user(self):
+        # signed for the root principal without asking for it
+        rule = PolicyRule('everyone', 'ssh_user', ['*', ], 'ssh-users')
+        self.assertFalse(rule.matches(UserSSHRequest('id', 'root', False, 'key')))
+
+        rule.root_allowed = True
+        self.assertTrue(rule.matches(UserSSHRequest('id', 'root', False, 'key')))
+
+    def test_rejected_at_submission(self):
+        response = submit_request({'keyType': 'ssh_user', 'userName': 'dev-x,root', 'keyData': 'key'})
+        self.assertTrue(response['failed'])
+
+    def test_ssl_names(self):
+        # not a principal, a certificate subject can have spaces
+        self.assertTrue(valid_receiver('ssl_user', 'John Doe'))
+        self.assertFalse(valid_receiver('ssh_user', 'John Doe'))
+
+
+class PolicyChangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.policy_path = os.path.join(self.directory, 'autosign.json')
+        self.write_policy('alice')
+
+    def write_policy(self, receiver):
+        with open(self.policy_path, 'w') as stream:
+            json.dump({'rules': [{'type': 'ssh_user', 'receiver': receiver, 'ca': 'ssh-users'}]}, stream)
+
+    def test_change_stops(self):
+        auto_signer = AutoSigner(load_policy(self.policy_path), self.policy_path)
+
+        self.write_policy('*')
+        stat = os.stat(self.policy_path)
+        os.utime(self.policy_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        # stopped before reading any request
+        with self.assertLogs('autosign', 'WARNING'):
+            auto_signer.process(None)
+
+        self.assertTrue(auto_signer.stopped.is_set())
+        # the confirmed rules are kept, the new ones are not read
+        self.assertEqual([rule.receivers for rule in auto_signer.rules], [['alice', ], ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+import uuid
+
+from ca_manager.models.request import key_fingerprint, reuse_hash
+from ca_manager.server import find_existing, handle_get_certificate, handle_get_certificate_batch
+
+
+class RequestIdTest(unittest.TestCase):
+
+    def test_path_outside_results(self):
+        for request_id in ('../../../tmp/x/y', '/etc/passwd', '', None, 42):
+            with self.subTest(request_id=request_id):
+                response, = handle_get_certificate({'requestID': request_id, 'timeout': 0})
+                self.assertEqual(response['reason'], 'bad_request_id')
+
+    def test_batch(self):
+        request_ids = [str(uuid.uuid4()), '../../../tmp/x/y']
+        response, = handle_get_certificate_batch({'requestIDs': request_ids, 'timeout': 0})
+        self.assertEqual(response['reason'], 'bad_request_id')
+
+    def test_pending(self):
+        request_id = str(uuid.uuid4())
+        response, = handle_get_certificate({'requestID': request_id, 'timeout': 0})
+        self.assertEqual(response['requestID'], request_id)
+
+
+class ReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        index_path = os.path.join(self.directory, '.reuse')
+        os.mkdir(index_path)
+        for name, value in (('RESULTS_PATH', self.directory), ('REUSE_INDEX_PATH', index_path)):
+            patcher = mock.patch('ca_manager.server.%s' % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.request = {'keyType': 'ssh_host', 'hostName': 'a.example.com', 'keyData': 'ssh-ed25519 AAAA host'}
+        self.cert_id = str(uuid.uuid4())
+        with open(os.path.join(self.directory, self.cert_id), 'w') as stream:
+            stream.write('certificate')
+
+        digest = reuse_hash('ssh_host', 'a.example.com', key_fingerprint('ssh-ed25519 AAAA other comment'))
+        self.link_path = os.path.join(index_path, digest)
+
+    def publish(self, validity):
+        os.symlink('%s:%d' % (self.cert_id, time.time() + validity), self.link_path)
+
+    def test_published(self):
+        self.publish(3600)
+        response = find_existing(self.request, 60)
+        self.assertEqual((response['requestID'], response['result'], response['reused']), (self.cert_id, 'certificate', True))
+
+    def test_expiring(self):
+        self.publish(3600)
+        self.assertIsNone(find_existing(self.request, 7200))
+
+    def test_withdrawn(self):
+        self.assertIsNone(find_existing(self.request, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()